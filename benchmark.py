@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Description: benchmarks of the patcher hot paths using generated banks and soundfonts
+    builds a bank of N patches using M soundfonts, with R router rules, L CC links,
+    and E effects per patch, times loading, patch selection, CC polling, and so on,
+    and writes the results as JSON so runs on different commits can be compared
+    uses fluidsynth's file audio driver writing to the null device, so no sound card is needed,
+    or runs without libfluidsynth if the environment variable FLUIDWRAP=stub is set, which also
+    reports the number of fluidsynth calls each operation would make
+"""
+import argparse, json, os, platform, subprocess, tempfile, time
+from array import array
+from math import sin, pi
+from struct import pack
+import patcher
+
+CCLINK_TARGETS = ['synth.gain', 'synth.reverb.level', 'synth.reverb.room-size',
+                  'synth.reverb.width', 'synth.chorus.level', 'synth.chorus.depth']
+
+def riff(ckid, data):
+    if len(data) & 1:
+        data += b'\0'
+    return ckid + pack('<I', len(data)) + data
+
+def write_sf2(path, npresets, frames=2000):
+# write a minimal soundfont with :npresets presets, each playing its own sine wave sample
+    smpl = array('h')
+    shdr = b''
+    for n in range(npresets):
+        start = len(smpl)
+        smpl.extend([int(8000 * sin(2 * pi * i * (n + 1) / 100)) for i in range(frames)])
+        smpl.extend([0] * 46)
+        shdr += pack('<20s5IBbHH', b'sample%d' % n, start, start + frames, start + 8, start + frames - 8, 44100, 60, 0, 0, 1)
+    shdr += pack('<20s5IBbHH', b'EOS', 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    phdr = pbag = pgen = inst = ibag = igen = b''
+    for n in range(npresets):
+        phdr += pack('<20sHHHIII', b'preset%d' % n, n % 128, n // 128, n, 0, 0, 0)
+        pbag += pack('<HH', n, 0)
+        pgen += pack('<HH', 41, n)
+        inst += pack('<20sH', b'inst%d' % n, n)
+        ibag += pack('<HH', n, 0)
+        igen += pack('<HH', 53, n)
+    phdr += pack('<20sHHHIII', b'EOP', 0, 0, npresets, 0, 0, 0)
+    pbag += pack('<HH', npresets, 0)
+    pgen += pack('<HH', 0, 0)
+    inst += pack('<20sH', b'EOI', npresets)
+    ibag += pack('<HH', npresets, 0)
+    igen += pack('<HH', 0, 0)
+    info = riff(b'ifil', pack('<HH', 2, 1)) + riff(b'isng', b'EMU8000\0') + riff(b'INAM', b'benchmark\0')
+    pdta = (riff(b'phdr', phdr) + riff(b'pbag', pbag) + riff(b'pmod', bytes(10)) + riff(b'pgen', pgen) +
+            riff(b'inst', inst) + riff(b'ibag', ibag) + riff(b'imod', bytes(10)) + riff(b'igen', igen) + riff(b'shdr', shdr))
+    body = (b'sfbk' + riff(b'LIST', b'INFO' + info) + riff(b'LIST', b'sdta' + riff(b'smpl', smpl.tobytes())) +
+            riff(b'LIST', b'pdta' + pdta))
+    with open(path, 'wb') as f:
+        f.write(riff(b'RIFF', body))
+
+def make_bank(args, sfonts):
+# yaml text of a bank with settings spread over the patches the way a real bank would
+    lines = ['router_rules: [default]', 'patches:']
+    for n in range(args.patches):
+        lines.append('  Patch %04d:' % (n + 1))
+        for chan in range(1, args.channels + 1):
+            sfont = sfonts[(n + chan) % len(sfonts)]
+            lines.append('    %d: %s:%03d:%03d' % (chan, sfont, 0, (n * args.channels + chan) % min(args.presets, 128)))
+        if args.rules:
+            lines.append('    router_rules:')
+            for r in range(args.rules):
+                chan = r % args.channels + 1
+                lo = (r * 12) % 120
+                lines.append('    - {type: note, chan: 1-1=%d-%d, par1: %d-%d*1%+d}' % (chan, chan, lo, lo + 11, r % 3 - 1))
+        if args.links:
+            lines.append('    cclinks:')
+            for l in range(args.links):
+                lines.append('    - {target: %s, link: 1/%d, xfrm: 0-127=0-1}' % (CCLINK_TARGETS[l % len(CCLINK_TARGETS)], 20 + l))
+        if args.effects:
+            lines.append('    effects:')
+            for e in range(args.effects):
+                lines.append('    - lib: %s' % args.plugin)
+                lines.append('      audioports: mono')
+                lines.append('      controls: [{port: Delay, val: 0.%d, link: 1/%d, xfrm: 0-127=0-5}]' % (e + 1, 60 + e))
+        lines.append('    cc: [%s]' % ', '.join(['%d/7=%d' % (chan, 100 - n % 20) for chan in range(1, args.channels + 1)]))
+    return '\n'.join(lines) + '\n'
+
+def measure(results, name, func, *args, synth=None):
+# call :func once, adding the time in milliseconds to the :name results
+# with the stand-in synth, also add the number of fluidsynth calls it made
+    cost = sum(synth.cost.values()) if hasattr(synth, 'cost') else None
+    t = time.perf_counter()
+    func(*args)
+    t = (time.perf_counter() - t) * 1000
+    if cost != None:
+        cost = sum(synth.cost.values()) - cost
+    results.setdefault(name, []).append((t, cost))
+
+def summarize(samples):
+    times = sorted([t for t, cost in samples])
+    summary = {'n': len(times),
+               'mean_ms': round(sum(times) / len(times), 4),
+               'p50_ms': round(times[(len(times) - 1) // 2], 4),
+               'p99_ms': round(times[(len(times) - 1) * 99 // 100], 4),
+               'max_ms': round(times[-1], 4)}
+    if samples[0][1] != None:
+        summary['synth_calls'] = sum([cost for t, cost in samples])
+    return summary
+
+def run(args, tmp):
+    sfdir = os.path.join(tmp, 'sf2')
+    bankdir = os.path.join(tmp, 'banks')
+    os.makedirs(sfdir)
+    os.makedirs(bankdir)
+    sfonts = ['bench%03d.sf2' % i for i in range(args.soundfonts)]
+    for sfont in sfonts:
+        write_sf2(os.path.join(sfdir, sfont), args.presets)
+    banktext = make_bank(args, sfonts)
+    with open(os.path.join(bankdir, 'bench.yaml'), 'w') as f:
+        f.write(banktext)
+    cfg = {'soundfontdir': sfdir, 'bankdir': bankdir, 'currentbank': 'bench.yaml',
+           'presetcache': os.path.join(tmp, 'presetcache.yaml'),
+           'fluidsettings': {'audio.driver': 'file', 'audio.file.name': os.devnull, 'midi.autoconnect': 0}}
+    for opt in args.set:
+        key, val = opt.split('=', 1)
+        cfg[key] = patcher.yamlext.safe_load(val)
+    cfgfile = os.path.join(tmp, 'benchconf.yaml')
+    with open(cfgfile, 'w') as f:
+        f.write(patcher.write_yaml(cfg))
+
+    # the active yaml backend (LibYAML if it's available) and the pure-python one
+    yamlext = patcher.yamlext
+    results = {}
+    for i in range(args.repeat):
+        measure(results, 'yaml_parse', patcher.read_yaml, banktext)
+        measure(results, 'yaml_parse_pure', yamlext.safe_load, banktext, yamlext.PyLoader)
+    bank = patcher.read_yaml(banktext)
+    for i in range(args.repeat):
+        measure(results, 'yaml_dump', patcher.write_yaml, bank)
+        measure(results, 'yaml_dump_pure', yamlext.safe_dump, bank, None, yamlext.PyDumper)
+
+    pxr = patcher.Patcher(cfgfile)
+    measure(results, 'load_bank_cold', pxr.load_bank, 'bench.yaml', synth=pxr._fluid)
+    for i in range(args.repeat):
+        measure(results, 'load_bank_warm', pxr.load_bank, 'bench.yaml', synth=pxr._fluid)
+
+    # the first pass after loading a bank is cold - lazy banks are parsed
+    # and compiled, and with dynamic sample loading the samples are read
+    pxr.load_bank('bench.yaml')
+    for n in range(pxr.patches_count()):
+        measure(results, 'select_patch_cold', pxr.select_patch, n, synth=pxr._fluid)
+    for i in range(args.repeat):
+        for n in range(pxr.patches_count()):
+            measure(results, 'select_patch_warm', pxr.select_patch, n, synth=pxr._fluid)
+
+    # CC messages go straight to the synth, as they would from the MIDI router
+    for n in range(min(pxr.patches_count(), args.repeat * 10)):
+        pxr.select_patch(n)
+        for i in range(args.ccload):
+            pxr._fluid.send_cc(0, 20 + i % max(args.links, 1), (n + i) % 128)
+        measure(results, 'poll_cc', pxr.poll_cc, synth=pxr._fluid)
+
+    for n in range(min(pxr.patches_count(), args.repeat * 10)):
+        pxr.select_patch(n)
+        measure(results, 'update_patch', pxr.update_patch, n, synth=pxr._fluid)
+
+    for sfont in sfonts:
+        measure(results, 'load_soundfont', pxr.load_soundfont, sfont, synth=pxr._fluid)
+    for sfont in sfonts:
+        measure(results, 'load_soundfont_cached', pxr.load_soundfont, sfont, synth=pxr._fluid)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the patcher hot paths')
+    parser.add_argument('-n', '--patches', type=int, default=100, help='patches in the bank')
+    parser.add_argument('-m', '--soundfonts', type=int, default=4, help='soundfonts used by the bank')
+    parser.add_argument('-p', '--presets', type=int, default=32, help='presets in each soundfont')
+    parser.add_argument('-c', '--channels', type=int, default=4, help='channels used by each patch')
+    parser.add_argument('-r', '--rules', type=int, default=4, help='router rules per patch')
+    parser.add_argument('-l', '--links', type=int, default=4, help='CC links per patch')
+    parser.add_argument('-e', '--effects', type=int, default=0, help='LADSPA effects per patch')
+    parser.add_argument('--plugin', default='/usr/lib/ladspa/delay.so', help='LADSPA plugin used for effects')
+    parser.add_argument('--ccload', type=int, default=64, help='CC messages sent before each poll_cc')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed passes')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VAL', help='add a config setting, e.g. patchdiff=1')
+    parser.add_argument('-o', '--output', default='', help='write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(args, tmp)
+    summary = {name: summarize(times) for name, times in results.items()}
+    report = {'commit': git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'libyaml': patcher.yamlext.LIBYAML,
+              'backend': patcher.fluidwrap.Synth.__module__,
+              'params': vars(args),
+              'results': summary,
+              'yaml_speedup': {op: round(summary[op + '_pure']['mean_ms'] / summary[op]['mean_ms'], 2)
+                               for op in ['yaml_parse', 'yaml_dump']}}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
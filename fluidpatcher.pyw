@@ -63,6 +63,7 @@ class SoundfontBrowser(wx.Dialog):
             style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
         self.sf = sf
         self.copypreset = ''
+        self.loaded = False
 
         self.presetlist = wx.ListCtrl(self, style=wx.LC_REPORT|wx.LC_SINGLE_SEL)
         self.presetlist.AppendColumn('Bank')
@@ -79,8 +80,8 @@ class SoundfontBrowser(wx.Dialog):
             for p in response:
                 self.presetlist.Append(("%03d:" % p.bank, "%03d:" % p.prog, p.name))
         else:
-            pxr.load_soundfont(sf)
-            for p in pxr.sfpresets:
+            # only load the soundfont into the synth once a preset is played
+            for p in pxr.soundfont_presets(sf) or []:
                 self.presetlist.Append(("%03d:" % p.bank, "%03d:" % p.prog, p.name))
         
         self.presetlist.SetColumnWidth(0, wx.LIST_AUTOSIZE_USEHEADER)
@@ -104,6 +105,9 @@ class SoundfontBrowser(wx.Dialog):
                 warn = patcher.read_yaml(response)
                 wx.MessageBox('\n'.join(warn), "Warning", wx.OK|wx.ICON_WARNING)
         else:
+            if not self.loaded:
+                pxr.load_soundfont(self.sf)
+                self.loaded = True
             warn = pxr.select_sfpreset(self.pno)
             if warn:
                 wx.MessageBox('\n'.join(warn), "Warning", wx.OK|wx.ICON_WARNING)
@@ -144,6 +148,8 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self.onBrowsePlugins, item)
         item = toolsMenu.Append(wx.ID_ANY, '&MIDI ports', 'List available MIDI devices')
         self.Bind(wx.EVT_MENU, self.onListMIDI, item)
+        item = toolsMenu.Append(wx.ID_ANY, 'Patch &Timing', 'Show how long patch and bank changes take')
+        self.Bind(wx.EVT_MENU, self.onTiming, item)
         toolsMenu.AppendSeparator()
         self.linkmenuitem = toolsMenu.Append(wx.ID_ANY, '&Remote Link', 'Connect to and control a remote unit')
         self.Bind(wx.EVT_MENU, self.onRemoteLink, self.linkmenuitem)
@@ -214,6 +220,9 @@ class MainWindow(wx.Frame):
             pxr.write_config()
             patches = pxr.patch_names()
             title = APP_NAME + ' - ' + bfile
+            warn = pxr.check_bank()
+            if warn:
+                wx.MessageBox('\n'.join(warn), "Warning", wx.OK|wx.ICON_WARNING)
         self.currentfile = bfile
         self.btxt.Clear()
         self.btxt.AppendText(rawbank)
@@ -395,6 +404,22 @@ class MainWindow(wx.Frame):
         tmsg.ShowModal()
         tmsg.Destroy()
 
+    def onTiming(self, event):
+        if remote.link:
+            stats = remote_link_request(netlink.TIMING_STATS)
+            if stats == None: return
+            caption = "Timings on %s (ms):" % remote.host
+        else:
+            stats = pxr.timing_stats()
+            caption = "Local timings (ms):"
+        if not stats:
+            stats = "No timings recorded - set 'timing: 1' in the config to enable"
+        else:
+            stats = patcher.write_yaml(stats)
+        tmsg = TextMsgDialog(stats, "Patch Timing", caption, size=(400, 450))
+        tmsg.ShowModal()
+        tmsg.Destroy()
+
     def onRemoteLink(self, event=None):
         if remote.link:
             self.remote_disconnect()
@@ -452,6 +477,9 @@ class MainWindow(wx.Frame):
             lastpatch = pxr.patch_name(self.pno)
             pxr.load_bank(rawbank)
             patches = pxr.patch_names()
+            warn = pxr.check_bank()
+            if warn:
+                wx.MessageBox('\n'.join(warn), "Warning", wx.OK|wx.ICON_WARNING)
         self.ptot = len(patches)
         self.patchlist.Clear()
         for p in patches:
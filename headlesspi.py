@@ -5,7 +5,7 @@ Description: an implementation of patcher.py for a headless Raspberry Pi
     patches/banks are changed using pads/buttons/knobs on the controller
     should work on other platforms as well
 """
-import time, re, sys, os, traceback, glob, subprocess, mido
+import time, re, sys, os, traceback, subprocess, mido
 import patcher
 from utils import netlink
 
@@ -68,14 +68,6 @@ else:
     onboardled_set(PWR_LED, 1, trigger='none') # red PWR led on
     onboardled_set(ACT_LED, 0, trigger='none') # green ACT led off
 
-def list_banks():
-    bpaths = sorted(glob.glob(os.path.join(pxr.bankdir, '**', '*.yaml'), recursive=True), key=str.lower)
-    return [os.path.relpath(x, start=pxr.bankdir) for x in bpaths]
-
-def list_soundfonts():
-    sfpaths = sorted(glob.glob(os.path.join(pxr.sfdir, '**', '*.sf2'), recursive=True), key=str.lower)
-    return [os.path.relpath(x, start=pxr.sfdir) for x in sfpaths]
-
 def select_patch(n):
     pxr.select_patch(n)
     onboardled_blink(ACT_LED)
@@ -115,6 +107,10 @@ if pxr.cfg.get('remotelink_active', 1): # allow link by default
     remote_link = netlink.Server(port, passkey)
 else:
     remote_link = None
+if pxr.cfg.get('metrics_port', 0):
+    metrics_server = netlink.MetricsServer(pxr.cfg['metrics_port'])
+else:
+    metrics_server = None
 
 # load bank
 try:
@@ -163,7 +159,7 @@ while True:
             pno = x
             select_patch(pno)
     elif 'incbank' in changed:
-        banks = list_banks()
+        banks = pxr.list_banks()
         if pxr.currentbank in banks:
             bno = banks.index(pxr.currentbank)
         else:
@@ -180,6 +176,10 @@ while True:
             pxr.write_config()    
 
 
+    # answer metrics scrapes
+    if metrics_server:
+        metrics_server.serve(pxr.metrics)
+
     # check remote link for requests and process them
     if remote_link and remote_link.pending():
         req = remote_link.requests.pop(0)
@@ -196,7 +196,7 @@ while True:
                 remote_link.reply(req, patcher.write_yaml(pxr.patch_names()))
                 
         elif req.type == netlink.LIST_BANKS:
-            banks = list_banks()
+            banks = pxr.list_banks()
             if not banks:
                 remote_link.reply(req, "no banks found!", netlink.REQ_ERROR)
             else:
@@ -241,7 +241,7 @@ while True:
                 onboardled_blink(ACT_LED)
                 
         elif req.type == netlink.LIST_SOUNDFONTS:
-            sf = list_soundfonts()
+            sf = pxr.list_soundfonts()
             if not sf:
                 remote_link.reply(req, "no soundfonts!", netlink.REQ_ERROR)
             else:
@@ -282,3 +282,12 @@ while True:
                 remote_link.reply(req, str(e), netlink.REQ_ERROR)
             else:
                 remote_link.reply(req)
+
+        elif req.type == netlink.SOUNDFONT_PROGRESS:
+            remote_link.reply(req, patcher.write_yaml(list(pxr.soundfont_progress())))
+
+        elif req.type == netlink.TIMING_STATS:
+            remote_link.reply(req, patcher.write_yaml(pxr.timing_stats(req.body == 'reset') or {}))
+
+        elif req.type == netlink.METRICS:
+            remote_link.reply(req, patcher.write_yaml(pxr.metrics()))
@@ -1,10 +1,12 @@
 """
 Description: a performance-oriented patch interface for fluidsynth
 """
-import re, mido
+import re, os, time, mido, threading
 from copy import deepcopy
-from os.path import relpath, join as joinpath
-from . import yamlext, cclink, fluidwrap
+from collections import deque
+from array import array
+from os.path import relpath, getsize, join as joinpath
+from . import yamlext, cclink, fluidwrap, presetcache, sfheader, lazybank, dircatalog, timing, render, tuning
 
 MAX_SF_BANK = 129
 MAX_SF_PROGRAM = 128
@@ -12,6 +14,7 @@ MAX_SF_PROGRAM = 128
 CC_DEFAULTS = [(7, 7, 100), (11, 11, 127), (12, 31, 0), (33, 42, 0),
                (43, 43, 127), (44, 63, 0), (65, 65, 0), (70, 79, 64),
                (80, 83, 0), (84, 84, 255), (85, 95, 0), (102, 119, 0)]
+CC_DEFAULT_VALS = [(cc, val) for first, last, val in CC_DEFAULTS for cc in range(first, last + 1)]
                
 SYNTH_DEFAULTS = {'synth.chorus.depth': 8.0, 'synth.chorus.level': 2.0,
                   'synth.chorus.nr': 3, 'synth.chorus.speed': 0.3,
@@ -19,6 +22,8 @@ SYNTH_DEFAULTS = {'synth.chorus.depth': 8.0, 'synth.chorus.level': 2.0,
                   'synth.reverb.room-size': 0.2, 'synth.reverb.width': 0.5,
                   'synth.gain': 0.2}
 
+TRANSFORM_TYPES = ['note', 'cc', 'prog', 'kpress', 'cpress']
+
 VERSION = '0.4.2'
 
 def read_yaml(text):
@@ -36,17 +41,58 @@ class PatcherError(Exception):
 
 class Patcher:
 
-    def __init__(self, cfgfile='', fluidsettings={}):
+    def __init__(self, cfgfile='', fluidsettings={}, offline=False):
         self._cfgfile = cfgfile
         self.cfg = {}
         self.read_config()
-        fluidsettings.update(self.cfg.get('fluidsettings', {}))
-        self._fluid = fluidwrap.Synth(**fluidsettings)        
+        fluidsettings = dict(fluidsettings, **self.cfg.get('fluidsettings', {}))
         self._max_channels = fluidsettings.get('synth.midi-channels', 16)
+        # with dynamic sample loading, spare channels above the MIDI channels
+        # hold the presets of neighboring patches so their samples are loaded
+        self._dynamic = fluidsettings.get('synth.dynamic-sample-loading', 0)
+        self._warm_channels = []
+        self._warm = {}
+        if self._dynamic and self.cfg.get('prefault', 1):
+            fluidsettings['synth.midi-channels'] = self._max_channels + self.cfg.get('prefaultchannels', 16)
+            self._warm_channels = list(range(self._max_channels, fluidsettings['synth.midi-channels']))
+        # fluidsynth spreads voices over worker threads, one per core, so
+        # layered patches aren't limited to one core, and each core gets
+        # the polyphony a single-core synth would have
+        cores = self.cfg.get('cpucores', 0)
+        if cores == 'auto':
+            cores = os.cpu_count() or 1
+        if cores:
+            fluidsettings['synth.cpu-cores'] = cores
+            fluidsettings['synth.polyphony'] = min(fluidsettings.get('synth.polyphony', 256) * cores, 65535)
+        self._fluid = fluidwrap.Synth(offline=offline, **fluidsettings)        
+        self._timing = timing.TimingStats(self.cfg.get('timingwindow', 256)) if self.cfg.get('timing', 0) else None
+        self._presetcache = presetcache.PresetCache(self.cfg.get('presetcache', joinpath(self.sfdir, '.presetcache.yaml')))
+        self._sfsamples = {}
+        self._bankcatalog = None
+        self._sfcatalog = None
+        if self.cfg.get('cctap', 0):
+            self._fluid.tap_ccs()
         self._bank = {'patches': {'No Patches': {}}}
-        self._soundfonts = set()
-        self._cc_links = []
+        self._index_patches()
+        self._soundfonts = []
+        self._sfneeded = []
+        self._sfqueue = []
+        self._sfloading = None
+        self._sfworker = None
+        self._sflock = threading.Condition()
+        self._cc_links = {}
+        self._cc_pending = {}
+        self._plans = {}
+        self._fluidsettings = {}
+        self._fxchain = None
+        self._fxvalues = {}
+        self._applied = {}
+        self._router_rules = 0
         self.sfpresets = []
+        self._overloads = 0
+        self._histograms = {'select_patch': timing.Histogram(), 'poll_cc': timing.Histogram()}
+        if self.cfg.get('loadwatch', 0) and not offline:
+            threading.Thread(target=self._loadwatch_run, args=(self.cfg['loadwatch'], ), daemon=True).start()
 
     @property
     def cfgfile(self):
@@ -95,9 +141,24 @@ class Patcher:
             f.write(write_yaml(self.cfg))
         f.close()
 
+    def list_banks(self):
+    # sorted list of bank files in bankdir, from an index kept up to date as files change
+        if not self._bankcatalog or self._bankcatalog.path != self.bankdir:
+            if self._bankcatalog: self._bankcatalog.close()
+            self._bankcatalog = dircatalog.DirCatalog(self.bankdir, '.yaml')
+        return self._bankcatalog.files()
+
+    def list_soundfonts(self):
+    # sorted list of soundfont files in soundfontdir, from an index kept up to date as files change
+        if not self._sfcatalog or self._sfcatalog.path != self.sfdir:
+            if self._sfcatalog: self._sfcatalog.close()
+            self._sfcatalog = dircatalog.DirCatalog(self.sfdir, '.sf2')
+        return self._sfcatalog.files()
+
     def load_bank(self, bank=None):
     # load patches, settings from :bank yaml string or filename
     # returns the file contents/yaml string
+        t = self._timing.begin('load_bank') if self._timing else timing.NULL
         if bank == None:
             bfile = self.currentbank
         else:
@@ -110,7 +171,11 @@ class Patcher:
         except (OSError, FileNotFoundError):
             pass
         try:
-            b = read_yaml(bank)
+            b = None
+            if self.cfg.get('lazybank', 0):
+                b = lazybank.read_bank(bank)
+            if b == None:
+                b = read_yaml(bank)
         except yamlext.YAMLError:
             raise PatcherError("Unable to parse bank data")
         self._bank = b
@@ -118,18 +183,31 @@ class Patcher:
             self._bank['patches'].values()
         except:
             self._bank = {'patches': {'No Patches': {}}}
+        t.mark('parse', 0)
+        self._index_patches()
+        self._compile_bank()
+        self._applied = {}
+        t.mark('compile', 0)
 
         self._reset_synth_defaults()
         self._send_cc_defaults()
+        t.mark('defaults', len(SYNTH_DEFAULTS) + 1)
         if 'init' in self._bank:
+            n = 0
             for opt, val in self._bank['init'].get('fluidsettings', {}).items():
                 self.fluid_set(opt, val)
+                n += 1
             for msg in self._bank['init'].get('cc', []):
                 self._fluid.send_cc(msg.chan - 1, msg.cc, msg.val)
+                n += 1
             for syx in self._bank['init'].get('sysex', []):
                 self._parse_sysex(syx)
+                n += 1
+            t.mark('init', n)
 
         self._reload_bankfonts()
+        t.mark('fonts', len(self._sfneeded))
+        if self._timing: self._timing.end(t)
         return bank
 
     def save_bank(self, bankfile='', raw=''):
@@ -144,6 +222,8 @@ class Patcher:
             except (yamlext.YAMLError, IOError):
                 raise PatcherError("Invalid bank data")
             self._bank = b
+            self._index_patches()
+            self._compile_bank()
             f.write(raw)
         else:
             f.write(write_yaml(self._bank))
@@ -151,82 +231,149 @@ class Patcher:
         self.cfg['currentbank'] = bankfile
 
     def patch_name(self, patch_index):
-        if patch_index >= len(self._bank['patches']):
+        if patch_index >= len(self._patchnames):
             raise PatcherError("Patch index out of range")
-        return list(self._bank['patches'])[patch_index]
+        return self._patchnames[patch_index]
         
     def patch_names(self):
-        return list(self._bank['patches'])
+        return list(self._patchnames)
         
     def patch_index(self, patch_name):
-        if patch_name not in self._bank['patches']:
+        if patch_name not in self._patchindex:
             raise PatcherError("Patch not found: %s" % patch_name)
-        return list(self._bank['patches']).index(patch_name)
+        return self._patchindex[patch_name]
 
     def patches_count(self):
-        return len(self._bank['patches'])
+        return len(self._patchnames)
 
     def select_patch(self, patch):
     # select :patch by index, name, or passing dict object
+    # if 'patchdiff' is set in the config, only change the parts of the
+    # synth state that differ from what the last selected patch applied
+        t = self._timing.begin('select_patch') if self._timing else timing.NULL
+        start = time.perf_counter()
         warnings = []
         self.sfpresets = []
-        patch = self._resolve_patch(patch)
+        plan = self._patch_plan(patch)
+        if self.cfg.get('patchdiff', 0):
+            applied = self._applied
+        else:
+            applied = {}
+        t.mark('compile', 0)
         
-        # select soundfont presets
-        for channel in range(1, self._max_channels + 1):
-            self._fluid.program_unset(channel - 1)
-            if channel not in patch: continue
-            preset = patch[channel]
+        # select soundfont presets, waiting for any that are still loading
+        # programs can also be changed by MIDI input, so compare against the synth
+        self._wait_soundfonts([preset.name for preset, sfont in plan['programs'] if preset])
+        t.mark('fonts', 0)
+        n = 0
+        for chan, (preset, sfont) in enumerate(plan['programs']):
+            if preset == None:
+                if not applied or self._fluid.program_info(chan):
+                    self._fluid.program_unset(chan)
+                    n += 1
+                continue
             if preset.name not in self._soundfonts:
                 self._reload_bankfonts()
-            if not self._fluid.program_select(channel - 1, joinpath(self.sfdir, preset.name), preset.bank, preset.prog):
-                warnings.append('Unable to select preset %s on channel %d' % (preset, channel))
+            if applied and self._fluid.program_info(chan) == (sfont, preset.bank, preset.prog):
+                continue
+            self._fluid.program_unset(chan)
+            if not self._fluid.program_select(chan, sfont, preset.bank, preset.prog):
+                warnings.append('Unable to select preset %s on channel %d' % (preset, chan + 1))
+            n += 2
+        t.mark('programs', n)
 
-        # link CC messages to parameters
-        for type in ['effect', 'fluidsetting']:
-            self.cclinks_clear(type)
-        for link in self._bank.get('cclinks', []) + patch.get('cclinks', []):
-            self.link_cc(**link.__dict__)
+        # activate LADSPA effects, keeping the current chain if it has the same plugins
+        n = 0
+        if plan['fxtopology'] == self._fxchain:
+            for label, port, val in plan['fxcontrols']:
+                if self._fxvalues.get((label, port)) != val:
+                    self._fluid.fx_setcontrol(label, port, val)
+                    self._fxvalues[(label, port)] = val
+                    n += 1
+        else:
+            self._fluid.fxchain_clear()
+            self._fxchain = plan['fxtopology']
+            self._fxvalues = {(label, port): val for label, port, val in plan['fxcontrols']}
+            active = False
+            n += 1
+            for lib, ops in plan['fxchain']:
+                for func, args in ops:
+                    n += 1
+                    if not func(*args) and func == self._fluid.fxchain_add:
+                        warnings.append("Could not connect plugin %s" % lib)
+                        self._fxchain = None
+                        break
+                else: active = True
+            if active: self._fluid.fxchain_activate()
+        t.mark('fx', n)
 
-        # activate LADSPA effects
-        self._fluid.fxchain_clear()
-        n = 1
-        for effect in self._bank.get('effects', []) + patch.get('effects', []):
-            name = 'e%s' % n
-            warn = self._fxplugin_connect(name, **effect)
-            if warn: warnings.append(warn)
-            else: n += 1
-        if n > 1: self._fluid.fxchain_activate()
+        # link CC messages to parameters
+        n = 0
+        if plan['cclinks'] != applied.get('cclinks') or plan['effects'] != applied.get('effects'):
+            for type in ['effect', 'fluidsetting']:
+                self.cclinks_clear(type)
+            for args in plan['links']:
+                self._add_cclink(cclink.CCLink(self._fluid, *args[:4], **args[4]))
+            n = len(plan['links'])
+        t.mark('links', n)
 
         # apply fluidsettings
-        for opt, val in self._bank.get('fluidsettings', {}).items():
-            self.fluid_set(opt, val)
-        for opt, val in patch.get('fluidsettings', {}).items():
+        n = 0
+        for opt, val in plan['fluidsettings']:
+            if applied and self._fluidsettings.get(opt) == val:
+                continue
             self.fluid_set(opt, val)
+            n += 1
+        t.mark('fluidsettings', n)
+
+        # set MIDI input transform tables
+        n = 0
+        if plan['transforms'] != applied.get('transforms'):
+            self._fluid.set_transforms(plan['transforms'])
+            n = 1
+        t.mark('transforms', n)
 
         # add MIDI router rules
-        self._fluid.router_clear()
-        self._fluid.router_default()
-        for rule in self._bank.get('router_rules', []) +  patch.get('router_rules', []):
-            if rule == 'clear': self._fluid.router_clear()
-            elif rule == 'default': self._fluid.router_default()
-            else:
-                self._midi_route(**rule.__dict__)
+        n = 0
+        if plan['router_rules'] != applied.get('router_rules'):
+            self._fluid.router_clear()
+            for func, args in plan['router_rules']:
+                func(*args)
+            self._router_rules = plan['router_counts'][1]
+            n = len(plan['router_rules']) + 1
+        t.mark('router', n)
 
         # send CC messages
-        for msg in self._bank.get('cc', []) + patch.get('cc', []):
-            if msg == 'default': self._send_cc_defaults()
-            else: self._fluid.send_cc(msg.chan - 1, msg.cc, msg.val)
+        for func, args in plan['cc']:
+            func(*args)
+        t.mark('cc', len(plan['cc']))
 
         # send SYSEX messages
-        for syx in self._bank.get('sysex', []) + patch.get('sysex', []):
+        for syx in plan['sysex']:
             warn = self._parse_sysex(syx)
             if warn: warnings.append(warn)
+        t.mark('sysex', len(plan['sysex']))
 
+        self._applied = plan
+
+        # load samples for the patches around this one, once it's fully applied
+        if self._warm_channels and not isinstance(patch, dict):
+            if isinstance(patch, str):
+                patch = self.patch_index(patch)
+            warnings += self._prefault_patches(patch, plan)
+            t.mark('prefault', len(self._warm_channels))
+
+        if self._timing: self._timing.end(t)
+        self._histograms['select_patch'].observe(time.perf_counter() - start)
         return warnings
 
     def add_patch(self, name, addlike=None):
     # new empty patch name :name, copying settings from :addlike
+        if name in self._patchindex:
+            self._plans.pop(id(self._bank['patches'][name]), None)
+        else:
+            self._patchindex[name] = len(self._patchnames)
+            self._patchnames.append(name)
         self._bank['patches'][name] = {}
         if addlike:
             addlike = self._resolve_patch(addlike)
@@ -237,65 +384,247 @@ class Patcher:
 
     def delete_patch(self, patch):
         if isinstance(patch, int):
-            name = list(self._bank['patches'])[patch]
+            name = self._patchnames[patch]
         else:
             name = patch
+        self._plans.pop(id(self._bank['patches'][name]), None)
         del self._bank['patches'][name]
+        i = self._patchindex.pop(name)
+        del self._patchnames[i]
+        for j in range(i, len(self._patchnames)):
+            self._patchindex[self._patchnames[j]] = j
         self._reload_bankfonts()
 
     def update_patch(self, patch):
     # update :patch in current bank with fluidsynth's present state
         patch = self._resolve_patch(patch)
-        for channel in range(1, self._max_channels + 1):
-            info = self._fluid.program_info(channel - 1)
-            if not info:
-                if channel in patch:
-                    del patch[channel]
+        self._plans.pop(id(patch), None)
+        state = self.snapshot()
+        cc_messages = []
+        for chan in state['chans']:
+            sfid, bank, prog = state['programs'][3 * chan:3 * chan + 3]
+            if sfid not in self._fluid.sfname:
+                if chan + 1 in patch:
+                    del patch[chan + 1]
                 continue
-            sfont, bank, prog = info
-            patch[channel] = yamlext.SFPreset(relpath(sfont, start=self.sfdir), bank, prog)
-            cc_messages = []
-            for first, last, default in CC_DEFAULTS:
-                for cc in range(first, last + 1):
-                    val = self._fluid.get_cc(channel - 1, cc)
-                    if val != default:
-                        cc_messages.append(yamlext.CCMsg(channel, cc, val))
+            sfont = relpath(self._fluid.sfname[sfid], start=self.sfdir)
+            patch[chan + 1] = yamlext.SFPreset(sfont, bank, prog)
+            for cc, default in CC_DEFAULT_VALS:
+                val = state['ccs'][128 * chan + cc]
+                if val != default:
+                    cc_messages.append(yamlext.CCMsg(chan + 1, cc, val))
         if cc_messages:
             patch['cc'] = cc_messages
 
+    def snapshot(self):
+    # capture programs, CCs, pitch bend, and synth settings of all channels
+        opts = sorted(set(SYNTH_DEFAULTS) | set(self._fluidsettings))
+        return self._fluid.snapshot(range(self._max_channels), opts)
+
+    def restore_snapshot(self, state):
+    # return the synth to a state captured by snapshot(), changing only what differs
+        self._fluid.restore(state)
+        for opt, val in state['settings'].items():
+            if val != None:
+                self._fluidsettings[opt] = val
+
     def load_soundfont(self, soundfont):
     # load a single :soundfont and scan all its presets
-        for sfont in self._soundfonts - {soundfont}:
-            self._fluid.unload_soundfont(joinpath(self.sfdir, sfont))
-        if {soundfont} - self._soundfonts:
-            if not self._fluid.load_soundfont(joinpath(self.sfdir, soundfont)):
-                self._soundfonts = set()
-                return False
-        self._soundfonts = {soundfont}
+        if soundfont in self._load_soundfonts([soundfont]):
+            return False
 
-        self.sfpresets = []
-        for bank in range(MAX_SF_BANK):
-            for prog in range(MAX_SF_PROGRAM):
-                name = self._fluid.get_preset_name(joinpath(self.sfdir, soundfont), bank, prog)
-                if not name:
-                    continue
-                self.sfpresets.append(yamlext.SFPreset(name, bank, prog))
+        self.sfpresets = self.soundfont_presets(soundfont)
+        if self.sfpresets == None:
+            sfpath = joinpath(self.sfdir, soundfont)
+            self.sfpresets = [yamlext.SFPreset(*p) for p in self._fluid.get_presets(sfpath)]
+            self._presetcache.put(sfpath, self.sfpresets)
+            self._presetcache.flush()
         if not self.sfpresets: return False
         for channel in range(0, self._max_channels):
             self._fluid.program_unset(channel)
+        self._applied = {}
+        self._fluid.set_transforms({})
         self._fluid.router_clear()
         self._fluid.router_default()
+        self._router_rules = 0
         self._fluid.fxchain_clear()
+        self._fxchain = None
         self._reset_synth_defaults()
         self._send_cc_defaults()
         self._midi_route('note', chan=yamlext.FromToSpec(2, self._max_channels, 0, 0))
         return True
         
+    def render_patch(self, patch, midi, wavfile, tail=2.0):
+    # select :patch, play :midi through it, and write the audio to :wavfile
+    # as fast as it can be rendered, which needs a Patcher created with offline=True
+    # returns (seconds of audio, seconds taken to render, warnings)
+        if not self._fluid.offline:
+            raise PatcherError("Rendering needs an offline Patcher")
+        try:
+            events = render.read_events(midi)
+        except (OSError, EOFError, ValueError):
+            raise PatcherError("Unable to read MIDI data")
+        warnings = self.select_patch(patch)
+        for chan in range(self._max_channels):
+            self._fluid.send_cc(chan, 120, 0)
+        rate = int(self._fluid.get_setting('synth.sample-rate'))
+        seconds, elapsed = render.render(self._fluid, events, wavfile, rate, tail)
+        return seconds, elapsed, warnings
+
+    def tune_audio(self, patches=None, polyphony=None, seconds=5.0, sizes=(64, 128, 256, 512, 1024),
+                   periods=(2, 3, 4, 6, 8, 16), margin=1.5):
+    # play :polyphony notes (default synth.polyphony) through each of :patches (default all)
+    # for :seconds, timing how long each block of audio takes to render with each period size
+    # in :sizes, and find the lowest-latency period size and count that never underruns
+    # render times are multiplied by :margin, leaving time for the MIDI and audio threads
+    # the result is set in the config's fluidsettings, to be saved with write_config
+    # needs a Patcher created with offline=True
+    # returns ((period-size, periods) or None, [(period-size, periods, latency ms, misses, underruns), ...])
+        if not self._fluid.offline:
+            raise PatcherError("Tuning needs an offline Patcher")
+        rate = int(self._fluid.get_setting('synth.sample-rate'))
+        polyphony = polyphony or self._fluid.get_setting('synth.polyphony')
+        if patches == None:
+            patches = range(self.patches_count())
+        times = {size: [] for size in sizes}
+        for patch in patches:
+            self.select_patch(patch)
+            plan = self._patch_plan(patch)
+            chans = [chan for chan, (preset, sfpath) in enumerate(plan['programs']) if preset] or [0]
+            events = tuning.stress_events(chans, polyphony, seconds)
+            for size in sizes:
+                for chan in range(self._max_channels):
+                    self._fluid.send_cc(chan, 120, 0)
+                times[size].append(array('d', [t * margin for t in tuning.time_blocks(self._fluid, events, rate, size)]))
+        results = []
+        for size in sizes:
+            for n in periods:
+                misses = sum([len([t for t in blocks if t > size / rate]) for blocks in times[size]])
+                underruns = sum([tuning.count_underruns(blocks, size / rate, n) for blocks in times[size]])
+                results.append((size, n, round(size * n / rate * 1000, 1), misses, underruns))
+        results.sort(key=lambda r: r[2])
+        for size, n, latency, misses, underruns in results:
+            if underruns == 0:
+                fsettings = self.cfg.setdefault('fluidsettings', {})
+                fsettings['audio.period-size'] = size
+                fsettings['audio.periods'] = n
+                return (size, n), results
+        return None, results
+
+    def overloads(self, reset=False):
+    # the number of CPU load samples at or over 100% since the synth started
+    # sampled every 'loadwatch' seconds if that's set in the config; this isn't a count
+    # of dropouts, since overloads between samples are missed and long ones are counted
+    # once per sample, but multiplied by 'loadwatch' it estimates the time spent overloaded
+        n = self._overloads
+        if reset:
+            self._overloads = 0
+        return n
+
+    def soundfont_progress(self):
+    # count the fonts needed by the current bank that are done loading
+    # returns (done, total)
+        with self._sflock:
+            pending = set(self._sfqueue + [self._sfloading])
+            return len([sfont for sfont in self._sfneeded if sfont not in pending]), len(self._sfneeded)
+
+    def soundfont_presets(self, soundfont):
+    # list the presets in :soundfont without loading it into fluidsynth,
+    # from the preset cache or by reading the file's preset headers
+    # returns None if the soundfont can't be read
+        presets = self._read_presets(soundfont)
+        self._presetcache.flush()
+        return presets
+
+    def soundfont_memory(self):
+    # estimate the sample memory used by each loaded soundfont from its headers
+    # with dynamic sample loading, only samples of presets selected on a channel count
+    # returns a dict of soundfont: bytes
+        selected = set()
+        for chan in list(range(self._max_channels)) + self._warm_channels:
+            selected.add(self._fluid.program_info(chan))
+        memory = {}
+        for sfont in self._soundfonts[:]:
+            if sfont not in self._sfsamples:
+                self._sfsamples[sfont] = sfheader.read_samples(joinpath(self.sfdir, sfont))
+            if self._sfsamples[sfont] == None:
+                continue
+            samples, sizes = self._sfsamples[sfont]
+            if self._dynamic:
+                sfpath = joinpath(self.sfdir, sfont)
+                ids = set()
+                for (bank, prog), sids in samples.items():
+                    if (sfpath, bank, prog) in selected:
+                        ids |= sids
+                memory[sfont] = sum([sizes[i] for i in ids])
+            else:
+                memory[sfont] = sum(sizes)
+        return memory
+
+    def router_rule_counts(self, patch):
+    # count the fluidsynth router rules for :patch before and after merging
+    # returns (before, after)
+        return self._patch_plan(patch)['router_counts']
+
+    def timing_stats(self, reset=False):
+    # rolling statistics of the phase timings of recent select_patch and load_bank calls
+    # returns {op: {phase: {'count', 'calls', 'p50', 'p99', 'max'}}} in milliseconds,
+    # or None if 'timing' isn't set in the config
+        if not self._timing:
+            return None
+        stats = self._timing.stats()
+        if reset:
+            self._timing.clear()
+        return stats
+
+    def last_timing(self, op='select_patch'):
+    # the Timing of the last :op call, or None
+        if not self._timing:
+            return None
+        return self._timing.last.get(op)
+
+    def metrics(self):
+    # a snapshot of how hard the synth is working: CPU load, voices in use, estimated
+    # soundfont memory, links and router rules of the current patch, overload samples, and
+    # histograms of poll_cc and select_patch times since the Patcher started
+    # returns a dict, with durations in milliseconds and memory in bytes
+        return {'cpu_load': round(self._fluid.cpu_load(), 2),
+                'voices': self._fluid.active_voices(),
+                'polyphony': self._fluid.get_setting('synth.polyphony'),
+                'overloads': self._overloads,
+                'soundfont_memory': self.soundfont_memory(),
+                'cclinks': sum([len(links) for types in list(self._cc_links.values()) for links in types.values()]),
+                'router_rules': self._router_rules,
+                'poll_cc': self._histograms['poll_cc'].summary(),
+                'select_patch': self._histograms['select_patch'].summary()}
+
+    def check_bank(self):
+    # look up the presets used by each patch in the current bank in their soundfonts' headers
+    # returns a list of warnings for soundfonts or presets that can't be found
+        warnings = []
+        sfpresets = {}
+        for name, patch in self._bank['patches'].items():
+            for channel in patch:
+                if not isinstance(channel, int):
+                    continue
+                preset = patch[channel]
+                if preset.name not in sfpresets:
+                    presets = self._read_presets(preset.name)
+                    if presets == None:
+                        warnings.append('Unable to read soundfont %s' % preset.name)
+                        sfpresets[preset.name] = None
+                    else:
+                        sfpresets[preset.name] = {(p.bank, p.prog) for p in presets}
+                if sfpresets[preset.name] != None and (preset.bank, preset.prog) not in sfpresets[preset.name]:
+                    warnings.append('%s: preset %s not found on channel %d' % (name, preset, channel))
+        self._presetcache.flush()
+        return warnings
+
     def select_sfpreset(self, presetnum):
         warnings = []
         if presetnum < len(self.sfpresets):
             p = self.sfpresets[presetnum]
-            soundfont = list(self._soundfonts)[0]
+            soundfont = self._soundfonts[-1]
             if not self._fluid.program_select(0, joinpath(self.sfdir, soundfont), p.bank, p.prog):
                 warnings.append('Unable to select preset %s' % p)
         else:
@@ -307,7 +636,9 @@ class Patcher:
 
     def fluid_set(self, opt, val, updatebank=False, patch=None):
         self._fluid.setting(opt, val)
+        self._fluidsettings[opt] = val
         if updatebank:
+            self._plans = {}
             self._bank['fluidsettings'][opt] = val
             if patch:
                 patch = self._resolve_patch(patch)
@@ -315,64 +646,230 @@ class Patcher:
                     patch['fluidsettings'].remove(opt)
 
     def link_cc(self, target, link='', type='fluidsetting', xfrm=yamlext.RouterSpec(0, 127, 1, 0), **kwargs):
-        if 'chan' in kwargs:
-            link = '%s/%s' % (kwargs['chan'], kwargs['cc'])
-        if not isinstance(xfrm, yamlext.YAMLObject):
-            try:
-                xfrm = read_yaml(xfrm)
-            except yamlext.YAMLError:
-                raise PatcherError("Badly formatted xfrm for CCLink")
-        if isinstance(xfrm, yamlext.FromToSpec):
-            xfrm = yamlext.RouterSpec.fromtospec(xfrm)        
-        self._cc_links.append(cclink.CCLink(self._fluid, target, link, type, xfrm, **kwargs))
+        target, link, type, xfrm, kwargs = self._cclink_args(target, link, type, xfrm, **kwargs)
+        self._add_cclink(cclink.CCLink(self._fluid, target, link, type, xfrm, **kwargs))
                 
     def poll_cc(self):
+    # read each linked CC once and update all the links that depend on it
+    # with 'cctap' set in the config, only CCs queued by the MIDI router tap
+    # are checked; other links get the latest value of their CC, and 'user' links
+    # get one value per call, with later values of that CC held back for the next
+    # calls, so each value reaches the returned dict in the order it arrived
+        start = time.perf_counter()
         retvals = {}
-        for link in self._cc_links:
-            if link.haschanged():
-                if link.xfrm.min <= link.val <= link.xfrm.max:
-                    val = link.val * link.xfrm.mul + link.xfrm.add
-                    if link.type == 'fluidsetting':
-                        self.fluid_set(link.target, val)
-                    elif link.type == 'effect':
-                        self._fluid.fx_setcontrol(link.target, link.port, val)
+        queue = self._fluid.ccqueue
+        if queue == None or self._fluid.cc_overflow:
+            if queue != None:
+                self._fluid.cc_overflow = False
+                queue.clear()
+                self._cc_pending = {}
+            events = {(chan, cc): [self._fluid.get_cc(chan - 1, cc)] for chan, cc in self._cc_links}
+        else:
+            events = {}
+            for key in list(self._cc_pending):
+                events[key] = [self._cc_pending[key].popleft()]
+                if not self._cc_pending[key]:
+                    del self._cc_pending[key]
+            while queue:
+                chan, cc, val = queue.popleft()
+                if cc == None:
+                    msgs = [(key, self._fluid.get_cc(chan, key[1])) for key in self._cc_links if key[0] == chan + 1]
+                else:
+                    msgs = [((chan + 1, cc), val)]
+                for key, val in msgs:
+                    if key in events and 'user' in self._cc_links.get(key, {}):
+                        pending = self._cc_pending.setdefault(key, deque())
+                        if len(pending) == queue.maxlen:
+                            self._fluid.cc_overflow = True
+                        else:
+                            pending.append(val)
                     else:
-                        retvals[link.target] = val
+                        events.setdefault(key, []).append(val)
+        for key, vals in events.items():
+            if key not in self._cc_links:
+                continue
+            for type, links in self._cc_links[key].items():
+                for link in links:
+                    if vals[-1] != link.val:
+                        link.val = vals[-1]
+                        self._cclink_apply(link, retvals)
+        self._histograms['poll_cc'].observe(time.perf_counter() - start)
         return retvals
         
     def cclinks_clear(self, type=''):
         if type:
-            self._cc_links = [link for link in self._cc_links if link.type != type]
+            for key in list(self._cc_links):
+                self._cc_links[key].pop(type, None)
+                if not self._cc_links[key]:
+                    del self._cc_links[key]
         else:
-            self._cc_links = []
+            self._cc_links = {}
+        self._cc_pending = {key: vals for key, vals in self._cc_pending.items() if 'user' in self._cc_links.get(key, {})}
         
     # private functions
     def _reload_bankfonts(self):
-        sfneeded = set()
-        for patch in self._bank['patches'].values():
-            for channel in patch:
-                if isinstance(channel, int):
-                    sfneeded |= {patch[channel].name}
+    # fonts are listed in patch order, so the first patches are ready first
+    # if 'sfasync' is set in the config, they load in a background thread
+        if isinstance(self._bank['patches'], lazybank.LazyPatches):
+            sfneeded = self._bank['patches'].soundfonts()
+        else:
+            sfneeded = []
+            for patch in self._bank['patches'].values():
+                for channel in patch:
+                    if isinstance(channel, int) and patch[channel].name not in sfneeded:
+                        sfneeded.append(patch[channel].name)
+        self._load_soundfonts(sfneeded, self.cfg.get('sfasync', 0))
+
+    def _load_soundfonts(self, sfneeded, background=False):
+    # make :sfneeded and the 'sfpinned' fonts resident, most recently used last,
+    # then unload least recently used fonts until they fit in 'sfbudget' megabytes
+    # if :background is set, fonts that aren't loaded are queued for _sfworker_run
+    # returns the set of fonts that failed to load
         missing = set()
-        for sfont in self._soundfonts - sfneeded:
+        self._prefault_clear()
+        with self._sflock:
+            pinned = [sfont for sfont in self.cfg.get('sfpinned', []) if sfont not in sfneeded]
+            self._sfneeded = pinned + sfneeded
+            self._sfqueue = []
+            while self._sfloading and not background:
+                self._sflock.wait()
+            for sfont in self._sfneeded:
+                if sfont in self._soundfonts:
+                    self._soundfonts.remove(sfont)
+                elif background:
+                    self._sfqueue.append(sfont)
+                    continue
+                elif not self._fluid.load_soundfont(joinpath(self.sfdir, sfont)):
+                    missing |= {sfont}
+                    continue
+                self._soundfonts.append(sfont)
+            if not self._sfqueue:
+                self._evict_soundfonts()
+            elif not self._sfworker:
+                self._sfworker = threading.Thread(target=self._sfworker_run, daemon=True)
+                self._sfworker.start()
+        return missing
+
+    def _read_presets(self, soundfont):
+    # get the presets of :soundfont from the preset cache or its headers,
+    # leaving the cache to be written once by the caller
+        sfpath = joinpath(self.sfdir, soundfont)
+        presets = self._presetcache.get(sfpath)
+        if presets == None:
+            presets = sfheader.read_presets(sfpath)
+            if presets != None:
+                self._presetcache.put(sfpath, presets)
+        return presets
+
+    def _sfworker_run(self):
+    # load queued soundfonts one at a time, releasing the lock while loading
+        with self._sflock:
+            while self._sfqueue:
+                self._sfloading = self._sfqueue.pop(0)
+                if self._sfloading not in self._soundfonts:
+                    self._sflock.release()
+                    loaded = self._fluid.load_soundfont(joinpath(self.sfdir, self._sfloading))
+                    self._sflock.acquire()
+                    if loaded:
+                        self._soundfonts.append(self._sfloading)
+                self._sfloading = None
+                self._sflock.notify_all()
+            self._evict_soundfonts()
+            self._sfworker = None
+
+    def _loadwatch_run(self, interval):
+    # sample the CPU load every :interval seconds and count the samples at or over 100%
+        while True:
+            time.sleep(interval)
+            if self._fluid.cpu_load() >= 100:
+                self._overloads += 1
+
+    def _prefault_patches(self, index, plan):
+    # select the presets of the patches up to 'prefault' places from :index on the
+    # spare channels, keeping ones that are already there, so switching to them
+    # doesn't wait for samples to load; presets in :plan are already loaded
+    # neighbors that can't be compiled are skipped
+    # returns a list of warnings
+        warnings = []
+        live = [(sfont, preset.bank, preset.prog) for preset, sfont in plan['programs'] if preset]
+        wanted = []
+        n = self.cfg.get('prefault', 1)
+        neighbors = []
+        for i in sorted(range(index - n, index + n + 1), key=lambda i: abs(i - index)):
+            if i % self.patches_count() not in neighbors + [index]:
+                neighbors.append(i % self.patches_count())
+        for i in neighbors:
+            try:
+                programs = self._patch_plan(i)['programs']
+            except Exception as e:
+                warnings.append('Unable to prefault patch %s: %s' % (self.patch_name(i), e))
+                continue
+            for preset, sfont in programs:
+                if preset and (sfont, preset.bank, preset.prog) not in live + wanted:
+                    wanted.append((sfont, preset.bank, preset.prog))
+        wanted = wanted[:len(self._warm_channels)]
+        free = [chan for chan in self._warm_channels if self._warm.get(chan) not in wanted]
+        for program in wanted:
+            if program not in self._warm.values():
+                chan = free.pop(0)
+                self._warm.pop(chan, None)
+                if self._fluid.program_select(chan, *program):
+                    self._warm[chan] = program
+                else:
+                    self._fluid.program_unset(chan)
+        for chan in free:
+            if chan in self._warm:
+                self._fluid.program_unset(chan)
+                del self._warm[chan]
+        return warnings
+
+    def _prefault_clear(self):
+    # release the presets on the spare channels so their soundfonts can be unloaded
+        for chan in self._warm:
+            self._fluid.program_unset(chan)
+        self._warm = {}
+
+    def _wait_soundfonts(self, sfonts):
+    # move :sfonts to the front of the background queue and wait until they're loaded
+        with self._sflock:
+            self._sfqueue.sort(key=lambda sfont: sfont not in sfonts)
+            while set(sfonts) & set(self._sfqueue + [self._sfloading]):
+                self._sflock.wait()
+
+    def _evict_soundfonts(self):
+    # called with _sflock held
+    # file sizes are used as the estimate of soundfont memory
+        sizes = {}
+        for sfont in self._soundfonts:
+            try:
+                sizes[sfont] = getsize(joinpath(self.sfdir, sfont))
+            except OSError:
+                sizes[sfont] = 0
+        total = sum(sizes.values())
+        for sfont in self._soundfonts[:]:
+            if total <= self.cfg.get('sfbudget', 0) * 1048576:
+                break
+            if sfont in self._sfneeded:
+                continue
             self._fluid.unload_soundfont(joinpath(self.sfdir, sfont))
-        for sfont in sfneeded - self._soundfonts:
-            if not self._fluid.load_soundfont(joinpath(self.sfdir, sfont)):
-                missing |= {sfont}
-        self._soundfonts = sfneeded - missing
+            self._soundfonts.remove(sfont)
+            total -= sizes[sfont]
 
     def _resolve_patch(self, patch):
         if isinstance(patch, int):
-            if patch < 0 or patch >= len(self._bank['patches']):
+            if patch < 0 or patch >= len(self._patchnames):
                 raise PatcherError("Patch index out of range")
-            name = list(self._bank['patches'])[patch]
-            patch = self._bank['patches'][name]
+            name = self._patchnames[patch]
         elif isinstance(patch, str):
             name = patch
-            if name not in self._bank['patches']:
+            if name not in self._patchindex:
                 raise PatcherError("Patch not found: %s" % name)
-            patch = self._bank['patches'][name]
-        return patch
+        else:
+            return patch
+        try:
+            return self._bank['patches'][name]
+        except yamlext.YAMLError:
+            raise PatcherError("Unable to parse patch %s" % name)
         
     def _parse_sysex(self, messages):
         ports = {}
@@ -391,7 +888,135 @@ class Patcher:
         except:
             return "Failed to parse or send SYSEX"
 
-    def _fxplugin_connect(self, name, lib, plugin=None, audioports='stereo', controls=[]):
+    def _add_cclink(self, link):
+    # links are indexed by (channel, cc), then by type
+        key = link.channel, link.cc
+        self._cc_links.setdefault(key, {}).setdefault(link.type, []).append(link)
+
+    def _cclink_apply(self, link, retvals):
+        if link.xfrm.min <= link.val <= link.xfrm.max:
+            val = link.val * link.xfrm.mul + link.xfrm.add
+            if link.type == 'fluidsetting':
+                self.fluid_set(link.target, val)
+            elif link.type == 'effect':
+                self._fluid.fx_setcontrol(link.target, link.port, val)
+                self._fxvalues[(link.target, link.port)] = val
+            else:
+                retvals[link.target] = val
+
+    def _index_patches(self):
+    # keep patch names in order and map them to indexes, so lookups
+    # don't have to list the bank's patches every time
+        self._patchnames = list(self._bank['patches'])
+        self._patchindex = {name: i for i, name in enumerate(self._patchnames)}
+
+    def _compile_bank(self):
+    # patches in lazy banks are parsed and compiled when they're first selected
+    # a patch that fails to compile keeps its error, which is raised when the
+    # patch is used, so one bad patch doesn't stop the bank from loading
+        self._plans = {}
+        if isinstance(self._bank['patches'], lazybank.LazyPatches):
+            return
+        for patch in self._bank['patches'].values():
+            try:
+                self._plans[id(patch)] = patch, self._compile_patch(patch)
+            except Exception as e:
+                self._plans[id(patch)] = patch, e
+
+    def _patch_plan(self, patch):
+    # get the compiled plan for :patch, compiling bank patches on demand
+        if isinstance(patch, int) or isinstance(patch, str):
+            patch = self._resolve_patch(patch)
+            if id(patch) not in self._plans:
+                self._plans[id(patch)] = patch, self._compile_patch(patch)
+        elif id(patch) not in self._plans:
+            return self._compile_patch(patch)
+        plan = self._plans[id(patch)][1]
+        if isinstance(plan, Exception):
+            raise plan
+        return plan
+
+    def _compile_patch(self, patch):
+    # resolve :patch and bank-level settings into lists of synth operations
+        plan = {}
+        plan['programs'] = [(None, None)] * self._max_channels
+        for channel in range(1, self._max_channels + 1):
+            if channel in patch:
+                preset = patch[channel]
+                plan['programs'][channel - 1] = preset, joinpath(self.sfdir, preset.name)
+
+        effects = self._bank.get('effects', []) + patch.get('effects', [])
+        plan['effects'] = repr(effects)
+        plan['fxchain'] = []
+        plan['fxcontrols'] = []
+        topology = []
+        fxlinks = []
+        for n, effect in enumerate(effects, start=1):
+            ops, controls = self._fxplugin_ops('e%s' % n, **effect)
+            plan['fxchain'].append((effect['lib'], ops))
+            ports = [ctrl.port for name, ctrl in controls]
+            topology.append((effect['lib'], effect.get('plugin'), effect.get('audioports', 'stereo'), ports))
+            for name, ctrl in controls:
+                if hasattr(ctrl, 'val'):
+                    plan['fxcontrols'].append((name, ctrl.port, ctrl.val))
+                if hasattr(ctrl, 'link'):
+                    fxlinks.append(self._cclink_args(name, type='effect', **ctrl.__dict__))
+
+        plan['fxtopology'] = repr(topology)
+
+        links = self._bank.get('cclinks', []) + patch.get('cclinks', [])
+        plan['cclinks'] = repr(links)
+        plan['links'] = [self._cclink_args(**link.__dict__) for link in links] + fxlinks
+
+        fsettings = dict(self._bank.get('fluidsettings', {}))
+        fsettings.update(patch.get('fluidsettings', {}))
+        plan['fluidsettings'] = list(fsettings.items())
+
+        # patch transforms replace bank transforms of the same type and channel
+        plan['transforms'] = {}
+        for xfrm in self._bank.get('transforms', []) + patch.get('transforms', []):
+            plan['transforms'].update(self._transform_tables(**xfrm.__dict__))
+
+        # setting the default rules removes all others, so only rules after
+        # the last 'clear' or 'default' are kept, which can then be merged
+        plan['router_rules'] = [(self._fluid.router_default, ())]
+        rules = []
+        for rule in self._bank.get('router_rules', []) +  patch.get('router_rules', []):
+            if rule == 'clear':
+                plan['router_rules'] = []
+                rules = []
+            elif rule == 'default':
+                plan['router_rules'] = [(self._fluid.router_default, ())]
+                rules = []
+            else:
+                rules += self._midi_rules(**rule.__dict__)
+        merged = self._merge_rules(rules)
+        plan['router_rules'] += [(self._fluid.router_addrule, r) for r in merged]
+        plan['router_counts'] = len(rules), len(merged)
+
+        plan['cc'] = []
+        for msg in self._bank.get('cc', []) + patch.get('cc', []):
+            if msg == 'default': plan['cc'].append((self._send_cc_defaults, ()))
+            else: plan['cc'].append((self._fluid.send_cc, (msg.chan - 1, msg.cc, msg.val)))
+
+        plan['sysex'] = self._bank.get('sysex', []) + patch.get('sysex', [])
+        return plan
+
+    def _cclink_args(self, target, link='', type='fluidsetting', xfrm=yamlext.RouterSpec(0, 127, 1, 0), **kwargs):
+    # normalize the arguments for a CCLink
+        if 'chan' in kwargs:
+            link = '%s/%s' % (kwargs['chan'], kwargs['cc'])
+        if not isinstance(xfrm, yamlext.YAMLObject):
+            try:
+                xfrm = read_yaml(xfrm)
+            except yamlext.YAMLError:
+                raise PatcherError("Badly formatted xfrm for CCLink")
+        if isinstance(xfrm, yamlext.FromToSpec):
+            xfrm = yamlext.RouterSpec.fromtospec(xfrm)
+        return target, link, type, xfrm, kwargs
+
+    def _fxplugin_ops(self, name, lib, plugin=None, audioports='stereo', controls=[]):
+    # returns the ops that add and connect a plugin, and its (label, control) pairs
         libpath = joinpath(self.plugindir, lib)
         if audioports == 'mono':
             audioports = ('Input', 'Output')
@@ -402,44 +1027,55 @@ class Patcher:
             names = (name, )
         elif len(audioports) == 2:
             names = (name + 'L', name + 'R')
+        ops = []
+        fxcontrols = []
         for x in names:
-            if not self._fluid.fxchain_add(x, libpath, plugin):
-                return "Could not connect plugin %s" % lib
+            ops.append((self._fluid.fxchain_add, (x, libpath, plugin)))
             for ctrl in controls:
                 if hasattr(ctrl, 'val'):
-                    self._fluid.fx_setcontrol(x, ctrl.port, ctrl.val)
-                if hasattr(ctrl, 'link'):
-                    self.link_cc(x, type='effect', **ctrl.__dict__)
+                    ops.append((self._fluid.fx_setcontrol, (x, ctrl.port, ctrl.val)))
+                fxcontrols.append((x, ctrl))
 
+        link = self._fluid.fxchain_link
         if len(names) == 1:
-            self._fluid.fxchain_link(names[0], audioports[0], 'Main:L')
-            self._fluid.fxchain_link(names[0], audioports[2], 'Main:L')
-            self._fluid.fxchain_link(names[0], audioports[1], 'Main:R')
-            self._fluid.fxchain_link(names[0], audioports[3], 'Main:R')
+            ops.append((link, (names[0], audioports[0], 'Main:L')))
+            ops.append((link, (names[0], audioports[2], 'Main:L')))
+            ops.append((link, (names[0], audioports[1], 'Main:R')))
+            ops.append((link, (names[0], audioports[3], 'Main:R')))
         elif len(names) == 2:
-            self._fluid.fxchain_link(names[0], audioports[0], 'Main:L')
-            self._fluid.fxchain_link(names[0], audioports[1], 'Main:L')
-            self._fluid.fxchain_link(names[1], audioports[0], 'Main:R')
-            self._fluid.fxchain_link(names[1], audioports[1], 'Main:R')
+            ops.append((link, (names[0], audioports[0], 'Main:L')))
+            ops.append((link, (names[0], audioports[1], 'Main:L')))
+            ops.append((link, (names[1], audioports[0], 'Main:R')))
+            ops.append((link, (names[1], audioports[1], 'Main:R')))
+        return ops, fxcontrols
 
     def _midi_route(self, type, chan=None, par1=None, par2=None, **kwargs):
     # send midi message routing rules to fluidsynth
+        for rule in self._merge_rules(self._midi_rules(type, chan, par1, par2)):
+            self._fluid.router_addrule(*rule)
+            self._router_rules += 1
+
+    def _midi_rules(self, type, chan=None, par1=None, par2=None, **kwargs):
+    # expand a router rule into a list of (type, chan, par1, par2) fluidsynth rules
         if isinstance(chan, yamlext.FromToSpec):
+            rules = []
             for chto in range(chan.to1, chan.to2 + 1):
                 ch = yamlext.RouterSpec(chan.from1, chan.from2, 0, chto)
-                self._midi_route(type, ch, par1, par2, **kwargs)
-            return
+                rules += self._midi_rules(type, ch, par1, par2)
+            return rules
         if isinstance(chan, yamlext.RouterSpec):
+            rules = []
             for chfrom in range(chan.min, chan.max + 1):
-                ch = [chfrom - 1, chfrom - 1, 0, chfrom * chan.mul + chan.add - 1]
-                self._midi_route(type, ch, par1, par2)
-            return
+                ch = (chfrom - 1, chfrom - 1, 0, chfrom * chan.mul + chan.add - 1)
+                rules += self._midi_rules(type, ch, par1, par2)
+            return rules
         if isinstance(par1, yamlext.FromToSpec):
             if type == 'cc':
+                rules = []
                 for ccto in range(par1.to1, par1.to2 + 1):
                     p = yamlext.RouterSpec(par1.from1, par1.from2, 0, ccto)
-                    self._midi_route(type, chan, p, par2, **kwargs)
-                return
+                    rules += self._midi_rules(type, chan, p, par2)
+                return rules
             else:
                 par1 = yamlext.RouterSpec.fromtospec(par1)
         if isinstance(par1, yamlext.RouterSpec):
@@ -448,13 +1084,108 @@ class Patcher:
             par2 = yamlext.RouterSpec.fromtospec(par2)
         if isinstance(par2, yamlext.RouterSpec):
             par2 = par2.vals
-        self._fluid.router_addrule(type, chan, par1, par2)
+        return [(type, chan, par1, par2)]
+
+    def _transform_tables(self, type, chan=None, par1=None, par2=None, **kwargs):
+    # compile a transform into lookup tables for the MIDI input stage
+    # :par2 can be a mapping of par1 ranges to curves, which gives a 128 * 128 table
+    # returns {(type, chan): (par1 table, par2 table)}
+        if type not in TRANSFORM_TYPES:
+            raise PatcherError("Unknown transform type: %s" % type)
+        try:
+            t1 = self._curve_table(par1) if par1 != None else None
+            if isinstance(par2, dict):
+                t2 = array('h', range(128)) * 128
+                for span, curve in par2.items():
+                    span = [yamlext.scinote_to_val(yamlext.sift(x)) for x in str(span).split('-')]
+                    lo, hi = span[0], span[-1]
+                    if not 0 <= lo <= hi <= 127:
+                        raise ValueError
+                    t2[lo * 128:(hi + 1) * 128] = self._curve_table(curve) * (hi + 1 - lo)
+            elif par2 != None:
+                t2 = self._curve_table(par2)
+            else:
+                t2 = None
+        except (TypeError, ValueError, IndexError):
+            raise PatcherError("Badly formatted transform: %s" % {'type': type, 'par1': par1, 'par2': par2})
+        # a note-on with velocity 0 is a note-off, so keep those and don't make new ones
+        if type == 'note' and t2:
+            for i in range(0, len(t2), 128):
+                t2[i] = 0
+                t2[i + 1:i + 128] = array('h', [1 if v == 0 else v for v in t2[i + 1:i + 128]])
+        return {(type, chan - 1 if chan else None): (t1, t2)}
+
+    def _curve_table(self, curve):
+    # 128-entry table from a list of 128 values, a list of [in, out] points
+    # joined by straight lines, a router spec, or the exponent of a power curve
+    # inputs outside the points or range, or that map outside 0-127, give -1
+        if isinstance(curve, yamlext.FromToSpec):
+            curve = yamlext.RouterSpec.fromtospec(curve)
+        if isinstance(curve, yamlext.RouterSpec):
+            lo, hi, mul, add = curve.vals
+            vals = [i * mul + add if lo <= i <= hi else -1 for i in range(128)]
+        elif isinstance(curve, (int, float)):
+            vals = [127 * (i / 127) ** curve for i in range(128)]
+        elif len(curve) == 128 and not isinstance(curve[0], list):
+            vals = list(curve)
+        else:
+            points = sorted([yamlext.scinote_to_val(x), yamlext.scinote_to_val(y)] for x, y in curve)
+            vals = [-1] * 128
+            for (x0, y0), (x1, y1) in zip(points, points[1:] or points):
+                for i in range(max(x0, 0), min(x1, 127) + 1):
+                    vals[i] = y0 + (y1 - y0) * (i - x0) / (x1 - x0) if x1 > x0 else y0
+        return array('h', [round(v) if 0 <= round(v) <= 127 else -1 for v in vals])
+
+    def _merge_rules(self, rules):
+    # drop duplicate fluidsynth rules, merge rules that route consecutive single
+    # channels to the same channel or with the same offset into one channel range rule,
+    # then join rules whose par1 ranges are adjacent and transformed the same way
+        merged = []
+        singles = {}
+        for type, chan, par1, par2 in dict.fromkeys(rules):
+            if chan and chan[0] == chan[1] and chan[2] == 0:
+                singles.setdefault((type, par1, par2), []).append((chan[0], chan[3]))
+            else:
+                merged.append((type, chan, par1, par2))
+        for (type, par1, par2), chans in singles.items():
+            chans.sort()
+            i = 0
+            while i < len(chans):
+                mul = None
+                j = i + 1
+                while j < len(chans) and chans[j][0] == chans[j - 1][0] + 1:
+                    step = chans[j][1] - chans[j - 1][1]
+                    if step not in (0, 1) or mul not in (None, step):
+                        break
+                    mul = step
+                    j += 1
+                first, out = chans[i]
+                if mul == None:
+                    merged.append((type, (first, first, 0, out), par1, par2))
+                else:
+                    merged.append((type, (first, chans[j - 1][0], float(mul), out - first * mul), par1, par2))
+                i = j
+        joined = []
+        spans = {}
+        for type, chan, par1, par2 in dict.fromkeys(merged):
+            if par1 and par1[0] <= par1[1]:
+                spans.setdefault((type, chan, par1[2:], par2), []).append(par1[:2])
+            else:
+                joined.append((type, chan, par1, par2))
+        for (type, chan, xfrm, par2), ranges in spans.items():
+            ranges.sort()
+            lo, hi = ranges[0]
+            for min, max in ranges[1:] + [(None, None)]:
+                if min == hi + 1:
+                    hi = max
+                else:
+                    joined.append((type, chan, (lo, hi) + xfrm, par2))
+                    lo, hi = min, max
+        return joined
 
     def _send_cc_defaults(self, channels=[]):
-        for channel in channels or range(1, self._max_channels + 1):
-            for first, last, default in CC_DEFAULTS:
-                for cc in range(first, last + 1):
-                    self._fluid.send_cc(channel - 1, cc, default)
+        chans = [channel - 1 for channel in channels] or range(self._max_channels)
+        self._fluid.reset_ccs(chans, CC_DEFAULT_VALS)
         
     def _reset_synth_defaults(self):
         cfg_fset = self.cfg.get('fluidsettings', {})
@@ -0,0 +1,114 @@
+"""
+Description: sorted index of the files in a directory tree, updated from inotify events
+or by rescanning periodically where inotify isn't available
+"""
+import os, struct, time
+from ctypes import CDLL
+from ctypes.util import find_library
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+try:
+    libc = CDLL(find_library('c'), use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError, TypeError):
+    libc = None
+
+class DirCatalog:
+
+    def __init__(self, path, ext, interval=2.0):
+        self.path = path
+        self.ext = ext
+        self.interval = interval
+        self._files = set()
+        self._sorted = None
+        self._scantime = 0
+        self._watches = {}
+        self._fd = None
+        if libc:
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+            if fd >= 0:
+                self._fd = fd
+        self._scan()
+
+    def files(self):
+    # sorted list of matching files, relative to the catalog's directory
+        if self._fd == None or not self._watches:
+            if time.time() - self._scantime > self.interval:
+                self._scan()
+        else:
+            self._read_events()
+        if self._sorted == None:
+            self._sorted = sorted(self._files, key=str.lower)
+        return list(self._sorted)
+
+    def close(self):
+        if self._fd != None:
+            os.close(self._fd)
+            self._fd = None
+        self._watches = {}
+
+    def _scan(self):
+    # walk the tree, skipping hidden files and directories as glob does
+    # watching a directory again returns its existing watch descriptor,
+    # so only the watches of directories that are gone are removed
+    # falls back to polling if a directory can't be watched
+        watches = self._watches
+        self._watches = {}
+        self._files = set()
+        self._sorted = None
+        self._scantime = time.time()
+        for root, dirs, files in os.walk(self.path, followlinks=True):
+            dirs[:] = [d for d in dirs if d[0] != '.']
+            if self._fd != None:
+                wd = libc.inotify_add_watch(self._fd, os.fsencode(root), WATCH_MASK)
+                if wd < 0:
+                    self.close()
+                else:
+                    self._watches[wd] = root
+            for f in files:
+                if f[0] != '.' and f.endswith(self.ext):
+                    self._files.add(os.path.relpath(os.path.join(root, f), self.path))
+        for wd in set(watches) - set(self._watches):
+            if self._fd != None:
+                libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+    # add and remove files named in pending events; any change to
+    # directories or a queue overflow just rescans the tree
+        buf = b''
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            buf += data
+        pos = 0
+        while pos + 16 <= len(buf):
+            wd, mask, cookie, size = struct.unpack_from('iIII', buf, pos)
+            name = os.fsdecode(buf[pos + 16:pos + 16 + size].rstrip(b'\0'))
+            pos += 16 + size
+            if mask & IN_IGNORED:
+                continue
+            if mask & (IN_Q_OVERFLOW | IN_ISDIR | IN_DELETE_SELF | IN_MOVE_SELF) or wd not in self._watches:
+                self._scan()
+                return
+            if name.startswith('.') or not name.endswith(self.ext):
+                continue
+            file = os.path.relpath(os.path.join(self._watches[wd], name), self.path)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._files.add(file)
+            else:
+                self._files.discard(file)
+            self._sorted = None
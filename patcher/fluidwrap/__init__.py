@@ -1,8 +1,14 @@
 """
 Description: ctypes wrapper for fluidsynth library
+    setting the environment variable FLUIDWRAP=stub selects an in-memory
+    stand-in that records calls instead of using libfluidsynth
 """
+import os
 
-try:
-    from .fluid2x import *
-except:
-    from .fluid1x import *
+if os.environ.get('FLUIDWRAP') == 'stub':
+    from .fluidstub import *
+else:
+    try:
+        from .fluid2x import *
+    except:
+        from .fluid1x import *
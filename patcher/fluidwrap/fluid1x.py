@@ -3,6 +3,8 @@ Description: ctypes bindings for fluidsynth 1.x
 """
 from ctypes import *
 from ctypes.util import find_library
+from collections import deque
+from array import array
 import os
 
 if hasattr(os, 'add_dll_directory'):
@@ -32,6 +34,16 @@ FL.new_fluid_midi_router.restype = c_void_p
 FL.new_fluid_midi_driver.argtypes = [c_void_p, fl_callback, c_void_p]
 FL.new_fluid_midi_driver.restype = c_void_p
 
+FL.delete_fluid_midi_router.argtypes = [c_void_p]
+FL.delete_fluid_midi_router.restype = None
+FL.delete_fluid_midi_driver.argtypes = [c_void_p]
+FL.delete_fluid_midi_driver.restype = None
+
+FL.new_fluid_midi_event.argtypes = []
+FL.new_fluid_midi_event.restype = c_void_p
+FL.delete_fluid_midi_event.argtypes = [c_void_p]
+FL.delete_fluid_midi_event.restype = c_int
+
 FL.new_fluid_midi_router_rule.argtypes = []
 FL.new_fluid_midi_router_rule.restype = c_void_p
 
@@ -64,10 +76,41 @@ FL.fluid_synth_cc.argtypes = [c_void_p, c_int, c_int, c_int]
 FL.fluid_synth_cc.restype = c_int
 FL.fluid_synth_get_cc.argtypes = [c_void_p, c_int, c_int, POINTER(c_int)]
 FL.fluid_synth_get_cc.restype = c_int
+FL.fluid_synth_pitch_bend.argtypes = [c_void_p, c_int, c_int]
+FL.fluid_synth_pitch_bend.restype = c_int
+FL.fluid_synth_get_pitch_bend.argtypes = [c_void_p, c_int, POINTER(c_int)]
+FL.fluid_synth_get_pitch_bend.restype = c_int
 FL.fluid_synth_noteon.argtypes = [c_void_p, c_int, c_int, c_int]
 FL.fluid_synth_noteon.restype = c_int
 FL.fluid_synth_noteoff.argtypes = [c_void_p, c_int, c_int]
 FL.fluid_synth_noteoff.restype = c_int
+FL.fluid_synth_write_float.argtypes = [c_void_p, c_int, c_void_p, c_int, c_int, c_void_p, c_int, c_int]
+FL.fluid_synth_write_float.restype = c_int
+FL.fluid_synth_get_cpu_load.argtypes = [c_void_p]
+FL.fluid_synth_get_cpu_load.restype = c_double
+FL.fluid_synth_get_active_voice_count.argtypes = [c_void_p]
+FL.fluid_synth_get_active_voice_count.restype = c_int
+
+FL.fluid_midi_event_get_type.argtypes = [c_void_p]
+FL.fluid_midi_event_get_type.restype = c_int
+FL.fluid_midi_event_get_channel.argtypes = [c_void_p]
+FL.fluid_midi_event_get_channel.restype = c_int
+FL.fluid_midi_event_get_control.argtypes = [c_void_p]
+FL.fluid_midi_event_get_control.restype = c_int
+FL.fluid_midi_event_get_value.argtypes = [c_void_p]
+FL.fluid_midi_event_get_value.restype = c_int
+FL.fluid_midi_event_get_key.argtypes = [c_void_p]
+FL.fluid_midi_event_get_key.restype = c_int
+FL.fluid_midi_event_get_velocity.argtypes = [c_void_p]
+FL.fluid_midi_event_get_velocity.restype = c_int
+FL.fluid_midi_event_set_key.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_key.restype = c_int
+FL.fluid_midi_event_set_velocity.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_velocity.restype = c_int
+FL.fluid_midi_event_set_type.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_type.restype = c_int
+FL.fluid_midi_event_set_channel.argtypes = [c_void_p, c_int]
+FL.fluid_midi_event_set_channel.restype = c_int
 
 FL.fluid_midi_router_handle_midi_event.argtypes = [c_void_p, c_void_p]
 FL.fluid_midi_router_handle_midi_event.restype = c_int
@@ -98,23 +141,46 @@ FL.fluid_synth_get_channel_info.restype = c_int
 
 FLUID_OK = 0
 FLUID_FAILED = -1
+CONTROL_CHANGE = 0xb0
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+NOTE_DROPPED = -2
+TRANSFORM_STATUS = {'note': (0x90, ), 'kpress': (0xa0, ), 'cc': (0xb0, ), 'prog': (0xc0, ), 'cpress': (0xd0, )}
+CHANNEL_MODE_CCS = range(120, 128)
 FLUIDSETTING_EXISTS = 1
 
 class Synth:
 
-    def __init__(self, **settings):
+    def __init__(self, offline=False, **settings):
+    # if :offline is set, no audio or MIDI drivers are created and
+    # audio is only produced by calling write_float
         self.st = FL.new_fluid_settings()
         for opt, val in settings.items():
             self.setting(opt, val)
 
         self.synth = FL.new_fluid_synth(self.st)
-        FL.new_fluid_audio_driver(self.st, self.synth)
+        self.offline = offline
+        if not offline:
+            FL.new_fluid_audio_driver(self.st, self.synth)
         self.synth_eventhandle = fl_callback(FL.fluid_synth_handle_midi_event)
         self.router = FL.new_fluid_midi_router(self.st, self.synth_eventhandle, self.synth)
         self.driver_eventhandle = fl_callback(FL.fluid_midi_router_handle_midi_event)
-        FL.new_fluid_midi_driver(self.st, self.driver_eventhandle, self.router)
+        self.mdriver = None if offline else FL.new_fluid_midi_driver(self.st, self.driver_eventhandle, self.router)
+        self.event = FL.new_fluid_midi_event()
+        self.audiobuf = (c_float * 2048)()
 
         self.sfid = {}
+        self.sfname = {}
+        # reusable buffers for reading synth state
+        self.ibuf = (c_int(), c_int(), c_int())
+        self.iref = tuple(byref(i) for i in self.ibuf)
+        # channels whose CCs haven't changed since reset_ccs
+        # only trusted if there is no MIDI input that could change them
+        self.cc_clean = set()
+        self.cc_tracked = not self.mdriver
+        self.ccqueue = None
+        self.cc_overflow = False
+        self.transforms = None
 
     def setting(self, opt, val):
         if isinstance(val, str):
@@ -141,11 +207,13 @@ class Synth:
         if id == FLUID_FAILED:
             return False
         self.sfid[sfont] = id
+        self.sfname[id] = sfont
         return True
 
     def unload_soundfont(self, sfont):
         if FL.fluid_synth_sfunload(self.synth, self.sfid[sfont], False) == FLUID_FAILED:
             return False
+        del self.sfname[self.sfid[sfont]]
         del self.sfid[sfont]
         return True
 
@@ -156,6 +224,17 @@ class Synth:
         FL.fluid_synth_get_channel_info(self.synth, 0, byref(info))
         return info.name.decode('ascii')
 
+    def get_presets(self, sfont):
+    # list (name, bank, prog) for all presets in :sfont, sorted by bank and program
+    # fluidsynth 1.x only exposes sfont iteration through struct callbacks, so probe
+        presets = []
+        for bank in range(129):
+            for prog in range(128):
+                name = self.get_preset_name(sfont, bank, prog)
+                if name:
+                    presets.append((name, bank, prog))
+        return presets
+
     def program_select(self, chan, sfont, bank, prog):
         if sfont not in self.sfid:
             return False
@@ -168,14 +247,11 @@ class Synth:
         FL.fluid_synth_unset_program(self.synth, chan)
 
     def program_info(self, chan):
-        id = c_int()
-        bank = c_int()
-        prog = c_int()
-        FL.fluid_synth_get_program(self.synth, chan, byref(id), byref(bank), byref(prog))
-        if id.value not in self.sfid.values():
+        id, bank, prog = self.ibuf
+        FL.fluid_synth_get_program(self.synth, chan, *self.iref)
+        if id.value not in self.sfname:
             return None
-        sfont = {v: k for k, v in self.sfid.items()}[id.value]
-        return sfont, bank.value, prog.value
+        return self.sfname[id.value], bank.value, prog.value
 
     def noteon(self, chan, key, vel):
         FL.fluid_synth_noteon(self.synth, chan, key, vel)
@@ -183,13 +259,189 @@ class Synth:
     def noteoff(self, chan, key):
         FL.fluid_synth_noteoff(self.synth, chan, key)
 
+    def midi_event(self, status, chan, par1, par2=0):
+    # pass a MIDI event through the transform stage and router as if it came from the MIDI driver
+    # :par1 is the key, controller, program, or pitch bend value, :par2 the velocity or value
+        if status == CONTROL_CHANGE:
+            self.cc_clean.clear()
+        FL.fluid_midi_event_set_type(self.event, status)
+        FL.fluid_midi_event_set_channel(self.event, chan)
+        FL.fluid_midi_event_set_key(self.event, par1)
+        FL.fluid_midi_event_set_velocity(self.event, par2)
+        self.driver_eventhandle(self.router, self.event)
+
+    def write_float(self, nframes):
+    # render :nframes of interleaved stereo audio into a reusable buffer
+    # returns a memoryview of the bytes of the 32-bit float samples
+        if len(self.audiobuf) < 2 * nframes:
+            self.audiobuf = (c_float * (2 * nframes))()
+        FL.fluid_synth_write_float(self.synth, nframes, self.audiobuf, 0, 2, self.audiobuf, 1, 2)
+        return memoryview(self.audiobuf).cast('B')[:8 * nframes]
+
+    def cpu_load(self):
+    # time taken to render audio as a percentage of the time it takes to play,
+    # averaged over the last few buffers
+        return FL.fluid_synth_get_cpu_load(self.synth)
+
+    def active_voices(self):
+        return FL.fluid_synth_get_active_voice_count(self.synth)
+
     def send_cc(self, chan, ctrl, val):
         FL.fluid_synth_cc(self.synth, chan, ctrl, val)
+        self.cc_clean.discard(chan)
+        if self.ccqueue != None:
+            self._queue_cc(chan, ctrl, val)
+
+    def reset_ccs(self, chans, ccvals):
+    # send (ctrl, val) pairs in :ccvals to each of :chans, skipping clean channels
+    # channels are marked clean before the writes, so a CC that arrives
+    # through the router tap while they're being made marks them dirty again
+        synth_cc = FL.fluid_synth_cc
+        synth = self.synth
+        for chan in chans:
+            if chan in self.cc_clean:
+                continue
+            if self.cc_tracked:
+                self.cc_clean.add(chan)
+            for ctrl, val in ccvals:
+                synth_cc(synth, chan, ctrl, val)
+            if self.ccqueue != None:
+                self._queue_cc(chan, None, None)
+
+    def tap_ccs(self, maxlen=1024):
+    # rebuild the MIDI router so routed events pass through a callback that
+    # queues (chan, ctrl, val) for each CC, also queue CCs sent by send_cc
+    # router rules are lost, and cc_overflow is set if the queue fills up
+        self.ccqueue = deque(maxlen=maxlen)
+        def tap(data, event):
+            if FL.fluid_midi_event_get_type(event) == CONTROL_CHANGE:
+                chan = FL.fluid_midi_event_get_channel(event)
+                self.cc_clean.discard(chan)
+                self._queue_cc(chan, FL.fluid_midi_event_get_control(event), FL.fluid_midi_event_get_value(event))
+            return FL.fluid_synth_handle_midi_event(data, event)
+        if self.mdriver:
+            FL.delete_fluid_midi_driver(self.mdriver)
+        FL.delete_fluid_midi_router(self.router)
+        self.synth_eventhandle = fl_callback(tap)
+        self.router = FL.new_fluid_midi_router(self.st, self.synth_eventhandle, self.synth)
+        if not self.offline:
+            self.mdriver = FL.new_fluid_midi_driver(self.st, self.driver_eventhandle, self.router)
+        self.cc_tracked = True
+
+    def set_transforms(self, tables):
+    # pass MIDI input through lookup tables before it reaches the router
+    # :tables maps (type, chan) to (par1 table, par2 table), with chan None for all channels
+    # a par2 table of 128 * 128 entries is indexed by par1 * 128 + par2
+    # events mapped to -1 are dropped
+    # the key each transformed note-on was sent as is kept, and its note-off is sent
+    # to the same key, so notes aren't left hanging if the tables change while held
+    # the MIDI driver is rebuilt with a callback the first time tables are set
+        if self.transforms == None:
+            if not tables:
+                return
+            self.noteroutes = array('h', [-1]) * (128 * self.get_setting('synth.midi-channels'))
+            def transform(data, event):
+                status = FL.fluid_midi_event_get_type(event)
+                if status == NOTE_OFF or status == NOTE_ON and FL.fluid_midi_event_get_velocity(event) == 0:
+                    i = FL.fluid_midi_event_get_channel(event) * 128 + FL.fluid_midi_event_get_key(event)
+                    if i < len(self.noteroutes) and self.noteroutes[i] != -1:
+                        key = self.noteroutes[i]
+                        self.noteroutes[i] = -1
+                        if key == NOTE_DROPPED:
+                            return FLUID_OK
+                        FL.fluid_midi_event_set_key(event, key)
+                    return FL.fluid_midi_router_handle_midi_event(self.router, event)
+                xfrms = self.transforms
+                if xfrms:
+                    chan = FL.fluid_midi_event_get_channel(event)
+                    xfrm = xfrms.get((status, chan)) or xfrms.get((status, None))
+                    if xfrm:
+                        t1, t2 = xfrm
+                        key = p1 = FL.fluid_midi_event_get_key(event)
+                        p2 = FL.fluid_midi_event_get_velocity(event)
+                        if t2:
+                            p2 = t2[p1 * 128 + p2] if len(t2) > 128 else t2[p2]
+                        if t1:
+                            p1 = t1[p1]
+                        if status == NOTE_ON and chan * 128 + key < len(self.noteroutes):
+                            self.noteroutes[chan * 128 + key] = NOTE_DROPPED if p1 < 0 or p2 < 0 else p1
+                        if p1 < 0 or p2 < 0:
+                            return FLUID_OK
+                        FL.fluid_midi_event_set_key(event, p1)
+                        FL.fluid_midi_event_set_velocity(event, p2)
+                return FL.fluid_midi_router_handle_midi_event(self.router, event)
+            if self.mdriver:
+                FL.delete_fluid_midi_driver(self.mdriver)
+            self.driver_eventhandle = fl_callback(transform)
+            if not self.offline:
+                self.mdriver = FL.new_fluid_midi_driver(self.st, self.driver_eventhandle, self.router)
+        transforms = {}
+        for (type, chan), (t1, t2) in tables.items():
+            for status in TRANSFORM_STATUS[type]:
+                transforms[(status, chan)] = t1, t2
+        self.transforms = transforms
+
+    def _queue_cc(self, chan, ctrl, val):
+        if len(self.ccqueue) == self.ccqueue.maxlen:
+            self.cc_overflow = True
+        self.ccqueue.append((chan, ctrl, val))
 
     def get_cc(self, chan, num):
-        i=c_int()
-        FL.fluid_synth_get_cc(self.synth, chan, num, byref(i))
-        return i.value
+        FL.fluid_synth_get_cc(self.synth, chan, num, self.iref[0])
+        return self.ibuf[0].value
+
+    def snapshot(self, chans, settings=()):
+    # read the program, all CCs, and pitch bend of each of :chans
+    # and the values of :settings into arrays in channel order
+        chans = list(chans)
+        state = {'chans': chans,
+                 'programs': array('i', [0]) * (3 * len(chans)),
+                 'ccs': array('B', [0]) * (128 * len(chans)),
+                 'pbend': array('H', [0]) * len(chans)}
+        synth = self.synth
+        get_cc = FL.fluid_synth_get_cc
+        a, b, c = self.ibuf
+        ra, rb, rc = self.iref
+        for i, chan in enumerate(chans):
+            FL.fluid_synth_get_program(synth, chan, ra, rb, rc)
+            state['programs'][3 * i] = a.value
+            state['programs'][3 * i + 1] = b.value
+            state['programs'][3 * i + 2] = c.value
+            for cc in range(128):
+                get_cc(synth, chan, cc, ra)
+                state['ccs'][128 * i + cc] = a.value
+            FL.fluid_synth_get_pitch_bend(synth, chan, ra)
+            state['pbend'][i] = a.value
+        state['settings'] = {opt: self.get_setting(opt) for opt in settings}
+        return state
+
+    def restore(self, state):
+    # write the parts of :state that differ from the synth's current state
+    # channel mode messages (CC 120-127) aren't restored
+    # returns the number of writes
+        current = self.snapshot(state['chans'], state['settings'])
+        n = 0
+        for i, chan in enumerate(state['chans']):
+            prog = state['programs'][3 * i:3 * i + 3]
+            if prog != current['programs'][3 * i:3 * i + 3]:
+                if prog[0] in self.sfname:
+                    FL.fluid_synth_program_select(self.synth, chan, *prog)
+                else:
+                    self.program_unset(chan)
+                n += 1
+            for cc in range(128):
+                val = state['ccs'][128 * i + cc]
+                if val != current['ccs'][128 * i + cc] and cc not in CHANNEL_MODE_CCS:
+                    self.send_cc(chan, cc, val)
+                    n += 1
+            if state['pbend'][i] != current['pbend'][i]:
+                FL.fluid_synth_pitch_bend(self.synth, chan, state['pbend'][i])
+                n += 1
+        for opt, val in state['settings'].items():
+            if val != None and val != current['settings'][opt]:
+                self.setting(opt, val)
+                n += 1
+        return n
 
     def router_clear(self):
         FL.fluid_midi_router_clear_rules(self.router)
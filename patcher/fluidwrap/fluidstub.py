@@ -0,0 +1,362 @@
+"""
+Description: in-memory stand-in for the fluidsynth bindings that records every call
+    keeps the synth state (settings, soundfonts, programs, CCs, router rules, effects chain)
+    so patcher works the same as with a real synth, without libfluidsynth or audio/MIDI devices
+    select it by setting the environment variable FLUIDWRAP=stub
+"""
+import atexit, os, pickle, time
+from collections import deque, Counter
+from array import array
+from .. import sfheader
+
+CONTROL_CHANGE = 0xb0
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+CHANNEL_MODE_CCS = range(120, 128)
+ROUTER_TYPES = ['note', 'cc', 'prog', 'pbend', 'cpress', 'kpress']
+TRANSFORM_STATUS = {'note': (0x90, ), 'kpress': (0xa0, ), 'cc': (0xb0, ), 'prog': (0xc0, ), 'cpress': (0xd0, )}
+
+SETTING_DEFAULTS = {'synth.midi-channels': 16, 'synth.polyphony': 256, 'synth.sample-rate': 44100.0,
+                    'synth.gain': 0.2, 'synth.cpu-cores': 1, 'synth.dynamic-sample-loading': 0,
+                    'audio.period-size': 64, 'audio.periods': 16, 'audio.driver': 'stub', 'midi.driver': 'stub'}
+
+def load_log(path):
+# read a call log saved by Synth.save_log
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def replay(calls, synth, realtime=False):
+# make the calls in a log on :synth, which can be a real or stand-in Synth
+# if :realtime is set, wait between calls to keep their original spacing
+# returns the time taken in seconds
+    start = time.perf_counter()
+    for t, name, args in calls:
+        if realtime:
+            wait = t - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+        getattr(synth, name)(*args)
+    return time.perf_counter() - start
+
+
+class Synth:
+
+    def __init__(self, offline=False, **settings):
+        self.calls = deque(maxlen=int(os.environ.get('FLUIDWRAP_LOGSIZE', 100000)))
+        self.cost = Counter()
+        self.inner = None
+        # costs follow fluid2x, or fluid1x if FLUIDWRAP_STUBAPI is 1
+        self.api = int(os.environ.get('FLUIDWRAP_STUBAPI', 2))
+        self.start = time.perf_counter()
+        self.st = dict(SETTING_DEFAULTS)
+        for opt, val in settings.items():
+            self.setting(opt, val)
+        self.channels = self.st['synth.midi-channels']
+        self.offline = offline
+        self.audiobuf = bytearray(8 * 1024)
+
+        self.sfid = {}
+        self.sfname = {}
+        self.presets = {}
+        self.nextid = 1
+        self.programs = [None] * self.channels
+        self.ccs = array('B', [0]) * (128 * self.channels)
+        self.pbend = array('H', [8192]) * self.channels
+        self.notes = {}
+        self.rules = ['default']
+        self.fxchain = []
+        self.fxlinks = []
+        self.fxcontrols = {}
+        self.fxactive = False
+        self.transforms = None
+        # stands in for a synth with a MIDI driver, so CC state is never trusted
+        self.cc_clean = set()
+        self.cc_tracked = False
+        self.ccqueue = None
+        self.cc_overflow = False
+        if os.environ.get('FLUIDWRAP_LOG'):
+            atexit.register(self.save_log, os.environ['FLUIDWRAP_LOG'])
+
+    def _record(self, name, args, cost=1):
+    # log a call with its time since the synth was created, and count
+    # the fluidsynth library calls the real bindings would make for it
+    # calls made by other methods are counted to the outer method but not logged, so logs replay exactly
+        if not self.inner:
+            self.calls.append((time.perf_counter() - self.start, name, args))
+        self.cost[self.inner or name] += cost
+
+    def _setting_cost(self, opt):
+    # get_setting tries getint, then copystr, then getnum
+        val = self.st.get(opt)
+        if isinstance(val, int):
+            return 1
+        if isinstance(val, str):
+            return 2
+        return 3
+
+    def save_log(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(list(self.calls), f)
+
+    def clear_log(self):
+        self.calls.clear()
+        self.cost.clear()
+
+    def setting(self, opt, val):
+        self._record('setting', (opt, val), int(isinstance(val, (str, int, float))))
+        if isinstance(val, (str, int, float)):
+            self.st[opt] = val
+
+    def get_setting(self, opt):
+        self._record('get_setting', (opt, ), self._setting_cost(opt))
+        val = self.st.get(opt)
+        if isinstance(val, float):
+            return round(val, 6)
+        return val
+
+    def load_soundfont(self, sfont):
+        self._record('load_soundfont', (sfont, ))
+        presets = sfheader.read_presets(sfont)
+        if presets == None:
+            return False
+        id = self.nextid
+        self.nextid += 1
+        self.sfid[sfont] = id
+        self.sfname[id] = sfont
+        self.presets[id] = {(p.bank, p.prog): p.name for p in presets}
+        return True
+
+    def unload_soundfont(self, sfont):
+        self._record('unload_soundfont', (sfont, ), int(sfont in self.sfid))
+        if sfont not in self.sfid:
+            return False
+        id = self.sfid.pop(sfont)
+        del self.sfname[id]
+        del self.presets[id]
+        for chan, prog in enumerate(self.programs):
+            if prog and prog[0] == id:
+                self.programs[chan] = None
+        return True
+
+    def get_preset_name(self, sfont, bank, prog):
+        name = self.presets[self.sfid[sfont]].get((bank, prog))
+        # fluid1x selects the preset on channel 0 and reads the channel info
+        self._record('get_preset_name', (sfont, bank, prog), 2 + bool(name) if self.api > 1 else 1 + bool(name))
+        return name
+
+    def get_presets(self, sfont):
+    # list (name, bank, prog) for all presets in :sfont, sorted by bank and program
+        presets = self.presets[self.sfid[sfont]]
+        # fluid1x probes every bank and program with get_preset_name
+        self._record('get_presets', (sfont, ), 3 + 4 * len(presets) if self.api > 1 else 129 * 128 + len(presets))
+        return sorted([(name, bank, prog) for (bank, prog), name in presets.items()], key=lambda p: p[1:])
+
+    def program_select(self, chan, sfont, bank, prog):
+        self._record('program_select', (chan, sfont, bank, prog), int(sfont in self.sfid))
+        if sfont not in self.sfid or (bank, prog) not in self.presets[self.sfid[sfont]]:
+            return False
+        self.programs[chan] = self.sfid[sfont], bank, prog
+        return True
+
+    def program_unset(self, chan):
+        self._record('program_unset', (chan, ))
+        self.programs[chan] = None
+
+    def program_info(self, chan):
+        self._record('program_info', (chan, ))
+        if not self.programs[chan]:
+            return None
+        id, bank, prog = self.programs[chan]
+        return self.sfname[id], bank, prog
+
+    def noteon(self, chan, key, vel):
+        self._record('noteon', (chan, key, vel))
+        if vel > 0:
+            self.notes[(chan, key)] = vel
+        else:
+            self.notes.pop((chan, key), None)
+
+    def noteoff(self, chan, key):
+        self._record('noteoff', (chan, key))
+        self.notes.pop((chan, key), None)
+
+    def midi_event(self, status, chan, par1, par2=0):
+    # track notes and CCs of a MIDI event as if it came from the MIDI driver
+    # router rules and transforms aren't applied, so events stay on their channels
+    # but the calls the transform and CC tap callbacks would make are counted
+        cost = 5
+        if self.transforms != None:
+            cost += 1 + (status == NOTE_ON)
+            if status == NOTE_OFF or status == NOTE_ON and par2 == 0:
+                cost += 2
+            elif self.transforms:
+                cost += 1
+                if (status, chan) in self.transforms or (status, None) in self.transforms:
+                    cost += 4
+        if self.ccqueue != None:
+            cost += 5 if status == CONTROL_CHANGE else 2
+        self._record('midi_event', (status, chan, par1, par2), cost)
+        if status == CONTROL_CHANGE:
+            self.cc_clean.clear()
+            self.ccs[128 * chan + par1] = par2
+            if self.ccqueue != None:
+                self._queue_cc(chan, par1, par2)
+        elif status == NOTE_ON and par2 > 0:
+            self.notes[(chan, par1)] = par2
+        elif status in (NOTE_ON, NOTE_OFF):
+            self.notes.pop((chan, par1), None)
+
+    def write_float(self, nframes):
+    # returns a memoryview of :nframes of silent interleaved 32-bit float stereo audio
+        self._record('write_float', (nframes, ))
+        if len(self.audiobuf) < 8 * nframes:
+            self.audiobuf = bytearray(8 * nframes)
+        return memoryview(self.audiobuf)[:8 * nframes]
+
+    def cpu_load(self):
+    # nothing is rendered, so there's no load
+        self._record('cpu_load', ())
+        return 0.0
+
+    def active_voices(self):
+    # one voice per held note, up to the polyphony
+        self._record('active_voices', ())
+        return min(len(self.notes), self.st['synth.polyphony'])
+
+    def send_cc(self, chan, ctrl, val):
+        self._record('send_cc', (chan, ctrl, val))
+        self.ccs[128 * chan + ctrl] = val
+        self.cc_clean.discard(chan)
+        if self.ccqueue != None:
+            self._queue_cc(chan, ctrl, val)
+
+    def reset_ccs(self, chans, ccvals):
+    # send (ctrl, val) pairs in :ccvals to each of :chans, skipping clean channels
+        chans = [chan for chan in chans if chan not in self.cc_clean]
+        self._record('reset_ccs', (chans, ccvals), len(chans) * len(ccvals))
+        for chan in chans:
+            if self.cc_tracked:
+                self.cc_clean.add(chan)
+            for ctrl, val in ccvals:
+                self.ccs[128 * chan + ctrl] = val
+            if self.ccqueue != None:
+                self._queue_cc(chan, None, None)
+
+    def tap_ccs(self, maxlen=1024):
+    # queue (chan, ctrl, val) for each CC sent
+        self._record('tap_ccs', (maxlen, ), 2 if self.offline else 4)
+        self.ccqueue = deque(maxlen=maxlen)
+        self.cc_tracked = True
+
+    def set_transforms(self, tables):
+    # keep the MIDI input lookup tables, see fluid2x.Synth.set_transforms
+    # the first tables read the channel count and rebuild the MIDI driver
+        first = self.transforms == None and tables
+        self._record('set_transforms', (tables, ), (1 if self.offline else 3) if first else 0)
+        if self.transforms == None and not tables:
+            return
+        transforms = {}
+        for (type, chan), (t1, t2) in tables.items():
+            for status in TRANSFORM_STATUS[type]:
+                transforms[(status, chan)] = t1, t2
+        self.transforms = transforms
+
+    def _queue_cc(self, chan, ctrl, val):
+        if len(self.ccqueue) == self.ccqueue.maxlen:
+            self.cc_overflow = True
+        self.ccqueue.append((chan, ctrl, val))
+
+    def get_cc(self, chan, num):
+        self._record('get_cc', (chan, num))
+        return self.ccs[128 * chan + num]
+
+    def snapshot(self, chans, settings=()):
+    # read the program, all CCs, and pitch bend of each of :chans
+    # and the values of :settings into arrays in channel order
+        chans = list(chans)
+        settings = list(settings)
+        self._record('snapshot', (chans, settings), len(chans) * 130 + sum(self._setting_cost(opt) for opt in settings))
+        state = {'chans': chans,
+                 'programs': array('i', [0]) * (3 * len(chans)),
+                 'ccs': array('B', [0]) * (128 * len(chans)),
+                 'pbend': array('H', [0]) * len(chans)}
+        for i, chan in enumerate(chans):
+            state['programs'][3 * i:3 * i + 3] = array('i', self.programs[chan] or (0, 0, 0))
+            state['ccs'][128 * i:128 * i + 128] = self.ccs[128 * chan:128 * chan + 128]
+            state['pbend'][i] = self.pbend[chan]
+        state['settings'] = {opt: self.st.get(opt) for opt in settings}
+        return state
+
+    def restore(self, state):
+    # write the parts of :state that differ from the synth's current state
+    # channel mode messages (CC 120-127) aren't restored
+    # returns the number of writes
+        self._record('restore', (state, ), 0)
+        self.inner = 'restore'
+        current = self.snapshot(state['chans'], state['settings'])
+        n = 0
+        for i, chan in enumerate(state['chans']):
+            prog = state['programs'][3 * i:3 * i + 3]
+            if prog != current['programs'][3 * i:3 * i + 3]:
+                if prog[0] in self.sfname:
+                    self.program_select(chan, self.sfname[prog[0]], prog[1], prog[2])
+                else:
+                    self.program_unset(chan)
+                n += 1
+            for cc in range(128):
+                val = state['ccs'][128 * i + cc]
+                if val != current['ccs'][128 * i + cc] and cc not in CHANNEL_MODE_CCS:
+                    self.send_cc(chan, cc, val)
+                    n += 1
+            if state['pbend'][i] != current['pbend'][i]:
+                self.pbend[chan] = state['pbend'][i]
+                self._record('pitch_bend', (chan, state['pbend'][i]))
+                n += 1
+        for opt, val in state['settings'].items():
+            if val != None and val != current['settings'][opt]:
+                self.setting(opt, val)
+                n += 1
+        self.inner = None
+        return n
+
+    def router_clear(self):
+        self._record('router_clear', ())
+        self.rules = []
+
+    def router_default(self):
+        self._record('router_default', ())
+        self.rules = ['default']
+
+    def router_addrule(self, type, chan, par1, par2):
+        self._record('router_addrule', (type, chan, par1, par2), 2 + bool(chan) + bool(par1) + bool(par2))
+        ROUTER_TYPES.index(type)
+        self.rules.append((type, chan, par1, par2))
+
+    def fxchain_clear(self):
+        self._record('fxchain_clear', (), int(self.api > 1))
+        self.fxchain = []
+        self.fxlinks = []
+        self.fxcontrols = {}
+        self.fxactive = False
+
+    def fxchain_add(self, label, lib, plugin):
+        self._record('fxchain_add', (label, lib, plugin), int(self.api > 1))
+        if not os.path.isfile(lib):
+            return False
+        self.fxchain.append((label, lib, plugin))
+        return True
+
+    def fxchain_link(self, label, fromport, toport):
+        self._record('fxchain_link', (label, fromport, toport), int(self.api > 1))
+        if label not in [fx[0] for fx in self.fxchain]:
+            return False
+        self.fxlinks.append((label, fromport, toport))
+        return True
+
+    def fxchain_activate(self):
+        self._record('fxchain_activate', (), int(self.api > 1))
+        self.fxactive = bool(self.fxchain)
+
+    def fx_setcontrol(self, label, port, val):
+        self._record('fx_setcontrol', (label, port, val), int(self.api > 1))
+        self.fxcontrols[(label, port)] = val
@@ -0,0 +1,116 @@
+"""
+Description: bank loading that indexes patches by name and parses each one when it's first used
+"""
+import re
+from collections.abc import MutableMapping
+from . import yamlext
+
+patchesex = re.compile('patches:\s*(#.*)?$')
+anchorex = re.compile('(?:^|[\s\[{,])&([^\s\]},]+)', re.M)
+aliasex = re.compile('(?:^|[\s\[{,])\*([^\s\]},]+)', re.M)
+keyex = re.compile('\s*("(?:[^"\\\\]|\\\\.)*"|\'(?:[^\']|\'\')*\'|[^\s\'"#{\[&*!|>%@`-][^#]*?):(\s|$)')
+sfontex = re.compile('^\s+\d+:\s+(.+?):\d+:\d+\s*(#.*)?$', re.M)
+
+class LazyPatches(MutableMapping):
+
+    def __init__(self, bodies):
+        self._bodies = bodies
+        self._patches = {}
+
+    def __getitem__(self, name):
+        if name not in self._patches:
+            text = self._bodies[name]
+            self._patches[name] = yamlext.safe_load('patches:\n' + text)['patches'][name]
+        return self._patches[name]
+
+    def __setitem__(self, name, patch):
+        self._bodies[name] = ''
+        self._patches[name] = patch
+
+    def __delitem__(self, name):
+        del self._bodies[name]
+        self._patches.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._bodies
+
+    def __iter__(self):
+        return iter(self._bodies)
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def soundfonts(self):
+    # list the soundfonts used by all patches in order,
+    # scanning the text of patches that haven't been parsed yet
+        sfonts = []
+        for name in self._bodies:
+            if name in self._patches:
+                patch = self._patches[name] or {}
+                names = [patch[channel].name for channel in patch if isinstance(channel, int)]
+            else:
+                names = [m[0] for m in sfontex.findall(self._bodies[name])]
+            for sfont in names:
+                if sfont not in sfonts:
+                    sfonts.append(sfont)
+        return sfonts
+
+    @staticmethod
+    def to_yaml(dumper, data):
+        return dumper.represent_dict(list(data.items()))
+
+yamlext.Dumper.add_representer(LazyPatches, LazyPatches.to_yaml)
+yamlext.PyDumper.add_representer(LazyPatches, LazyPatches.to_yaml)
+
+
+def read_bank(text):
+# parse the bank-level sections of :text and index the text of each patch by name
+# returns the bank with its patches in a LazyPatches, or None if the patches can't
+# be split up (no block-style 'patches' section, multiple documents, or aliases
+# of anchors in other patches or sections)
+    if '---' in text:
+        return None
+    lines = text.splitlines(True)
+    for start, line in enumerate(lines):
+        if patchesex.match(line):
+            break
+    else:
+        return None
+    end = start + 1
+    while end < len(lines) and (lines[end][0] in ' \t#\r\n'):
+        end += 1
+    # split the block at lines with the same indent as the first patch name,
+    # then parse all the names together so they resolve the same as in a full parse
+    indent = None
+    keys, texts = [], []
+    for line in lines[start + 1:end]:
+        if line.strip() and line.lstrip()[0] != '#':
+            if indent == None:
+                indent = len(line) - len(line.lstrip())
+            if len(line) - len(line.lstrip()) == indent:
+                m = keyex.match(line)
+                if not m:
+                    return None
+                keys.append(m[1] + ':\n')
+                texts.append('')
+        if texts:
+            texts[-1] += line
+    try:
+        names = list(yamlext.safe_load(''.join(keys)) or {})
+    except yamlext.YAMLError:
+        return None
+    if len(names) != len(texts):
+        return None
+    bodies = dict(zip(names, texts))
+    head, tail = ''.join(lines[:start]), ''.join(lines[end:])
+    for section in [head, tail] + list(bodies.values()):
+        if set(aliasex.findall(section)) - set(anchorex.findall(section)):
+            return None
+    head = yamlext.safe_load(head) or {}
+    tail = yamlext.safe_load(tail) or {}
+    if not isinstance(head, dict) or not isinstance(tail, dict):
+        return None
+    bank = dict(head)
+    bank['patches'] = LazyPatches(bodies)
+    bank.update(tail)
+    return bank
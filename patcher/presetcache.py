@@ -0,0 +1,67 @@
+"""
+Description: on-disk cache of soundfont preset lists, keyed by file path, size and modification time
+"""
+import os
+from . import yamlext
+
+class PresetCache:
+
+    def __init__(self, cachefile=''):
+        self.cachefile = cachefile
+        self.entries = None
+        self.dirty = False
+
+    def get(self, sfont):
+    # return the cached list of SFPresets for :sfont, or None if missing or stale
+        self._read()
+        entry = self.entries.get(os.path.abspath(sfont))
+        if entry == None:
+            return None
+        try:
+            stat = os.stat(sfont)
+        except OSError:
+            return None
+        if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            return None
+        return list(entry['presets'])
+
+    def put(self, sfont, presets):
+    # store the presets of :sfont, which are written to the cache file by flush
+        self._read()
+        try:
+            stat = os.stat(sfont)
+        except OSError:
+            return
+        self.entries[os.path.abspath(sfont)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'presets': list(presets)}
+        self.dirty = True
+
+    def flush(self):
+    # write the cache file if anything was put since it was last written
+        if self.dirty:
+            self._write()
+            self.dirty = False
+
+    def _read(self):
+        if self.entries != None:
+            return
+        self.entries = {}
+        if not self.cachefile:
+            return
+        try:
+            f = open(self.cachefile)
+            entries = yamlext.safe_load(f.read())
+            f.close()
+        except (OSError, yamlext.YAMLError):
+            return
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    def _write(self):
+        if not self.cachefile:
+            return
+        try:
+            f = open(self.cachefile, 'w')
+            f.write(yamlext.safe_dump(self.entries))
+            f.close()
+        except OSError:
+            pass
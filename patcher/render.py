@@ -0,0 +1,72 @@
+"""
+Description: offline rendering of MIDI through a synth into 32-bit float WAV files
+"""
+import struct, time, mido
+
+MIDI_STATUS = {'note_off': 0x80, 'note_on': 0x90, 'polytouch': 0xa0, 'control_change': 0xb0,
+               'program_change': 0xc0, 'aftertouch': 0xd0, 'pitchwheel': 0xe0}
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+def read_events(midi):
+# convert :midi (a MIDI file name, a mido.MidiFile, or a list of (seconds, mido.Message))
+# into a list of (seconds, status, chan, par1, par2) sorted by time
+    if isinstance(midi, str):
+        midi = mido.MidiFile(midi)
+    if isinstance(midi, mido.MidiFile):
+        t = 0
+        timed = []
+        for msg in midi:
+            t += msg.time
+            timed.append((t, msg))
+    else:
+        timed = sorted(midi, key=lambda e: e[0])
+    events = []
+    for t, msg in timed:
+        if msg.type not in MIDI_STATUS:
+            continue
+        if msg.type in ('note_on', 'note_off'):
+            pars = msg.note, msg.velocity
+        elif msg.type == 'polytouch':
+            pars = msg.note, msg.value
+        elif msg.type == 'control_change':
+            pars = msg.control, msg.value
+        elif msg.type == 'program_change':
+            pars = msg.program, 0
+        elif msg.type == 'aftertouch':
+            pars = msg.value, 0
+        else:
+            pars = msg.pitch + 8192, 0
+        events.append((t, MIDI_STATUS[msg.type], msg.channel) + pars)
+    return events
+
+def wav_header(rate, nframes, channels=2):
+# header of a WAV file of 32-bit float samples
+    size = nframes * channels * 4
+    return (b'RIFF' + struct.pack('<I', 50 + size) + b'WAVE' +
+            b'fmt ' + struct.pack('<IHHIIHHH', 18, WAVE_FORMAT_IEEE_FLOAT, channels, rate, rate * channels * 4, channels * 4, 32, 0) +
+            b'fact' + struct.pack('<II', 4, nframes) +
+            b'data' + struct.pack('<I', size))
+
+def render(synth, events, wavfile, rate, tail=2.0, blocksize=1024):
+# send :events to :synth at their times while pulling audio from it in blocks of
+# at most :blocksize frames, and write the audio plus :tail seconds to :wavfile
+# returns (seconds of audio, seconds taken)
+    end = (events[-1][0] if events else 0) + tail
+    f = open(wavfile, 'wb')
+    f.write(wav_header(rate, 0))
+    done = 0
+    start = time.perf_counter()
+    for t, *event in events + [(end, )]:
+        frames = int(t * rate) - done
+        while frames > 0:
+            n = min(frames, blocksize)
+            f.write(synth.write_float(n))
+            frames -= n
+            done += n
+        if event:
+            synth.midi_event(*event)
+    elapsed = time.perf_counter() - start
+    f.seek(0)
+    f.write(wav_header(rate, done))
+    f.close()
+    return done / rate, elapsed
@@ -0,0 +1,101 @@
+"""
+Description: reads preset headers from SF2/SF3 soundfont files without loading their sample data
+"""
+import mmap, struct
+from . import yamlext
+
+PHDR_SIZE = 38
+INSTRUMENT = 41
+SAMPLE_ID = 53
+SAMPLE_COMPRESSED = 0x10
+
+def read_presets(sfont):
+# memory-map :sfont and read the preset headers in its pdta/phdr chunk
+# returns a list of SFPresets sorted by bank and program,
+# or None if the file can't be read or isn't a soundfont
+    try:
+        f = open(sfont, 'rb')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+    except (OSError, ValueError):
+        return None
+    try:
+        if mm[0:4] != b'RIFF' or mm[8:12] != b'sfbk':
+            return None
+        pdta = _find_chunk(mm, 12, len(mm), b'LIST', b'pdta')
+        if pdta == None:
+            return None
+        phdr = _find_chunk(mm, pdta[0] + 4, pdta[1], b'phdr')
+        if phdr == None:
+            return None
+        presets = []
+        # the last header is the terminal 'EOP' record
+        for pos in range(phdr[0], phdr[1] - 2 * PHDR_SIZE + 1, PHDR_SIZE):
+            name, prog, bank = struct.unpack_from('<20sHH', mm, pos)
+            name = name.split(b'\0')[0].decode('latin-1')
+            presets.append(yamlext.SFPreset(name, bank, prog))
+    except struct.error:
+        return None
+    finally:
+        mm.close()
+    presets.sort(key=lambda p: (p.bank, p.prog))
+    return presets
+
+def read_samples(sfont):
+# follow each preset's zones through its instruments to the samples they play
+# returns a dict of (bank, prog): set of sample indexes and a list of sample sizes in bytes,
+# or None if the file can't be read; compressed SF3 samples count their compressed size
+    try:
+        f = open(sfont, 'rb')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+    except (OSError, ValueError):
+        return None
+    try:
+        if mm[0:4] != b'RIFF' or mm[8:12] != b'sfbk':
+            return None
+        pdta = _find_chunk(mm, 12, len(mm), b'LIST', b'pdta')
+        if pdta == None:
+            return None
+        chunks = {}
+        for ckid, fmt in (b'phdr', '<20x2H1H12x'), (b'pbag', '<H2x'), (b'pgen', '<2H'), (b'inst', '<20xH'), (b'ibag', '<H2x'), (b'igen', '<2H'), (b'shdr', '<20x2I16xH'):
+            chunk = _find_chunk(mm, pdta[0] + 4, pdta[1], ckid)
+            if chunk == None:
+                return None
+            size = struct.calcsize(fmt)
+            chunks[ckid] = [struct.unpack_from(fmt, mm, pos) for pos in range(chunk[0], chunk[1] - size + 1, size)]
+    except struct.error:
+        return None
+    finally:
+        mm.close()
+    # offsets of compressed samples are in bytes, others in 16-bit frames
+    sizes = []
+    for start, end, type in chunks[b'shdr']:
+        sizes.append(max(end - start, 0) * (1 if type & SAMPLE_COMPRESSED else 2))
+    samples = {}
+    for i in range(len(chunks[b'phdr']) - 1):
+        prog, bank, pbag = chunks[b'phdr'][i]
+        samples[(bank, prog)] = ids = set()
+        for inst in _zone_gens(chunks[b'pbag'], chunks[b'pgen'], pbag, chunks[b'phdr'][i + 1][2], INSTRUMENT):
+            if inst + 1 < len(chunks[b'inst']):
+                ibag, ibagend = chunks[b'inst'][inst][0], chunks[b'inst'][inst + 1][0]
+                ids |= {sid for sid in _zone_gens(chunks[b'ibag'], chunks[b'igen'], ibag, ibagend, SAMPLE_ID) if sid < len(sizes)}
+    return samples, sizes
+
+def _zone_gens(bags, gens, first, last, oper):
+# amounts of generator :oper in zones :first to :last of :bags
+    for bag in range(first, min(last, len(bags) - 1)):
+        for gen in range(bags[bag][0], min(bags[bag + 1][0], len(gens))):
+            if gens[gen][0] == oper:
+                yield gens[gen][1]
+
+def _find_chunk(mm, start, end, ckid, listtype=None):
+# find the chunk :ckid (of :listtype if it's a LIST) between :start and :end
+# returns the (start, end) offsets of its data, or None
+    pos = start
+    while pos + 8 <= end:
+        cid, size = struct.unpack_from('<4sI', mm, pos)
+        if cid == ckid and (listtype == None or mm[pos + 8:pos + 12] == listtype):
+            return pos + 8, min(pos + 8 + size, end)
+        pos += 8 + size + (size & 1)
+    return None
@@ -0,0 +1,106 @@
+"""
+Description: timing of the phases of patcher operations, with rolling statistics
+    and latency histograms
+"""
+import time
+from bisect import bisect_left
+from collections import deque
+
+class Timing:
+
+    def __init__(self, op):
+        self.op = op
+        self.phases = {}
+        self.start = self._last = time.perf_counter()
+
+    def mark(self, phase, calls=1):
+    # charge the time since the previous mark to :phase, along with
+    # the number of synth calls it made
+        now = time.perf_counter()
+        if phase in self.phases:
+            secs, n = self.phases[phase]
+            self.phases[phase] = secs + now - self._last, n + calls
+        else:
+            self.phases[phase] = now - self._last, calls
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.start
+
+    def __repr__(self):
+        phases = ', '.join(['%s %.3fms/%d' % (p, secs * 1000, n) for p, (secs, n) in self.phases.items()])
+        return '%s %.3fms: %s' % (self.op, self.total * 1000, phases)
+
+
+class NullTiming:
+# stands in for a Timing when timing is off, so marking phases costs one call
+
+    def mark(self, phase, calls=1):
+        pass
+
+NULL = NullTiming()
+
+
+class TimingStats:
+
+    def __init__(self, window=256):
+        self.window = window
+        self.last = {}
+        self._samples = {}
+
+    def begin(self, op):
+        return Timing(op)
+
+    def end(self, timing):
+    # add the phases of a finished :timing to the rolling window for its operation
+        self.last[timing.op] = timing
+        for phase, sample in list(timing.phases.items()) + [('total', (timing.total, 0))]:
+            key = timing.op, phase
+            if key not in self._samples:
+                self._samples[key] = deque(maxlen=self.window)
+            self._samples[key].append(sample)
+
+    def stats(self):
+    # summarize the window for each operation and phase
+    # returns {op: {phase: {'count', 'calls', 'p50', 'p99', 'max'}}} with times in milliseconds
+        stats = {}
+        for (op, phase), samples in list(self._samples.items()):
+            samples = list(samples)
+            times = sorted([secs * 1000 for secs, n in samples])
+            stats.setdefault(op, {})[phase] = {'count': len(times),
+                                               'calls': sum([n for secs, n in samples]),
+                                               'p50': round(times[(len(times) - 1) // 2], 3),
+                                               'p99': round(times[(len(times) - 1) * 99 // 100], 3),
+                                               'max': round(times[-1], 3)}
+        return stats
+
+    def clear(self):
+        self.last = {}
+        self._samples = {}
+
+
+class Histogram:
+# counts of durations in fixed buckets, cheap enough to always be on
+
+    BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, secs):
+        ms = secs * 1000
+        self.counts[bisect_left(self.bounds, ms)] += 1
+        self.sum += ms
+
+    def summary(self):
+    # returns {'count', 'sum', 'buckets'}, with the sum in milliseconds and buckets
+    # mapping each upper bound in milliseconds to the count at or below it
+        buckets = {}
+        n = 0
+        for bound, count in zip(self.bounds + (float('inf'), ), self.counts):
+            n += count
+            buckets[bound] = n
+        return {'count': n, 'sum': round(self.sum, 3), 'buckets': buckets}
@@ -0,0 +1,59 @@
+"""
+Description: audio buffer tuning - stress workloads, block render timing, and underrun simulation
+"""
+import time
+from array import array
+from collections import deque
+
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+
+def stress_events(chans, polyphony, seconds, spacing=0.005):
+# a list of (seconds, status, chan, par1, par2) events that starts a note every :spacing seconds
+# on :chans in turn until :polyphony notes are held, then releases the oldest note as each
+# new one starts, so the synth stays near :polyphony voices (plus releases and layers)
+    events = []
+    held = deque()
+    n = 0
+    while n * spacing < seconds:
+        t = n * spacing
+        if len(held) >= polyphony:
+            events.append((t, NOTE_OFF, *held.popleft(), 0))
+        chan = chans[n % len(chans)]
+        key = 36 + n * 7 % 60
+        events.append((t, NOTE_ON, chan, key, 100))
+        held.append((chan, key))
+        n += 1
+    return events
+
+def time_blocks(synth, events, rate, blocksize):
+# send :events to :synth at their times, rendering audio in blocks of :blocksize frames
+# the way an audio driver would, with events quantized to block boundaries
+# returns an array of the seconds taken to render each block
+    times = array('d')
+    clock = time.perf_counter
+    done = 0
+    for t, *event in events:
+        while done + blocksize <= t * rate:
+            start = clock()
+            synth.write_float(blocksize)
+            times.append(clock() - start)
+            done += blocksize
+        synth.midi_event(*event)
+    return times
+
+def count_underruns(times, period, periods):
+# simulate a driver playing through :periods buffers of :period seconds each
+# while a renderer that takes :times fills them in turn; the renderer can start
+# on a buffer once it has been played out, and playback waits for late buffers
+# returns the number of times playback had to wait
+    underruns = 0
+    lag = 0
+    ready = 0
+    for i, r in enumerate(times):
+        ready = max(ready, i * period + lag) + r
+        deadline = (i + periods - 1) * period + lag
+        if ready > deadline:
+            underruns += 1
+            lag += ready - deadline
+    return underruns
@@ -2,8 +2,26 @@
 Description: extensions to YAML classes for patcher
 """
 import re, oyaml
-from oyaml import safe_load, safe_load_all, safe_dump, safe_dump_all, YAMLError, YAMLObject
+from oyaml import YAMLError, YAMLObject
 
+# use the LibYAML parser/emitter when PyYAML was built with it
+# the pure-Python classes are kept for comparison and as a fallback
+class PyLoader(oyaml.SafeLoader):
+    pass
+
+class PyDumper(oyaml.SafeDumper):
+    pass
+
+if hasattr(oyaml, 'CSafeLoader'):
+    class Loader(oyaml.CSafeLoader):
+        pass
+
+    class Dumper(oyaml.CSafeDumper):
+        pass
+else:
+    Loader, Dumper = PyLoader, PyDumper
+
+LIBYAML = Loader != PyLoader
 
 sfpex = re.compile('^(.+):(\d+):(\d+)$')
 ccmsgex = re.compile('^([0-9]+)/([0-9]+)=([0-9]+)$')
@@ -34,8 +52,8 @@ def scinote_to_val(val):
 class SFPreset(YAMLObject):
 
     yaml_tag = '!sfpreset'
-    yaml_loader = oyaml.SafeLoader
-    yaml_dumper = oyaml.SafeDumper
+    yaml_loader = Loader
+    yaml_dumper = Dumper
 
     def __init__(self, name, bank, prog):
         self.name = name
@@ -60,8 +78,8 @@ class SFPreset(YAMLObject):
 class CCMsg(YAMLObject):
 
     yaml_tag = '!ccmsg'
-    yaml_loader = oyaml.SafeLoader
-    yaml_dumper = oyaml.SafeDumper
+    yaml_loader = Loader
+    yaml_dumper = Dumper
 
     def __init__(self, chan, cc, val):
         self.chan = chan
@@ -85,8 +103,8 @@ class CCMsg(YAMLObject):
 class RouterSpec(YAMLObject):
 
     yaml_tag = '!rspec'
-    yaml_loader = oyaml.SafeLoader
-    yaml_dumper = oyaml.SafeDumper
+    yaml_loader = Loader
+    yaml_dumper = Dumper
     
     def __init__(self, min, max, mul, add):
         self.min = min
@@ -128,8 +146,8 @@ class RouterSpec(YAMLObject):
 class FromToSpec(YAMLObject):
 
     yaml_tag = '!ftspec'
-    yaml_loader = oyaml.SafeLoader
-    yaml_dumper = oyaml.SafeDumper
+    yaml_loader = Loader
+    yaml_dumper = Dumper
     
     def __init__(self, from1, from2, to1, to2):
         self.from1 = from1
@@ -138,7 +156,7 @@ class FromToSpec(YAMLObject):
         self.to2 = to2
         
     def __repr__(self):
-        return '%s-%s=%s-%s' % (data.from1, data.from2, data.to1, data.to2)
+        return '%s-%s=%s-%s' % (self.from1, self.from2, self.to1, self.to2)
         
     @property
     def vals(self):
@@ -159,8 +177,8 @@ class FromToSpec(YAMLObject):
 class FlowSeq(YAMLObject):
 
     yaml_tag = '!flowseq'
-    yaml_loader = oyaml.SafeLoader
-    yaml_dumper = oyaml.SafeDumper
+    yaml_loader = Loader
+    yaml_dumper = Dumper
 
     def __init__(self, items):
         self.items = items
@@ -189,8 +207,8 @@ class FlowSeq(YAMLObject):
 class FlowMap(YAMLObject):
 
     yaml_tag = '!flowmap'
-    yaml_loader = oyaml.SafeLoader
-    yaml_dumper = oyaml.SafeDumper
+    yaml_loader = Loader
+    yaml_dumper = Dumper
     
     def __init__(self, **kwargs):
         for a in kwargs:
@@ -199,6 +217,9 @@ class FlowMap(YAMLObject):
     def __iter__(self):
         return iter(self.__dict__.items())
 
+    def __repr__(self):
+        return '{%s}' % ', '.join(['%s: %s' % (k, v) for k, v in self])
+
     @classmethod
     def from_yaml(cls, loader, node):
         return cls(**loader.construct_mapping(node))
@@ -208,20 +229,41 @@ class FlowMap(YAMLObject):
         return dumper.represent_mapping('!flowmap', data, flow_style=True)
 
 
-handlers = dict(Loader=oyaml.SafeLoader, Dumper=oyaml.SafeDumper)
+def safe_load(stream, Loader=Loader):
+    return oyaml.load(stream, Loader=Loader)
 
-oyaml.add_implicit_resolver('!sfpreset', sfpex, **handlers)
-oyaml.add_implicit_resolver('!ccmsg', ccmsgex, **handlers)
-oyaml.add_implicit_resolver('!rspec', rspecex, **handlers)
-oyaml.add_implicit_resolver('!ftspec', ftspecex, **handlers)
+def safe_load_all(stream, Loader=Loader):
+    return oyaml.load_all(stream, Loader=Loader)
+
+def safe_dump(data, stream=None, Dumper=Dumper, **kwds):
+    return oyaml.dump_all([data], stream, Dumper=Dumper, **kwds)
+
+def safe_dump_all(documents, stream=None, Dumper=Dumper, **kwds):
+    return oyaml.dump_all(documents, stream, Dumper=Dumper, **kwds)
+
+handlers = [dict(Loader=Loader, Dumper=Dumper)]
+if LIBYAML:
+    handlers.append(dict(Loader=PyLoader, Dumper=PyDumper))
+    for cls in SFPreset, CCMsg, RouterSpec, FromToSpec, FlowSeq, FlowMap:
+        PyLoader.add_constructor(cls.yaml_tag, cls.from_yaml)
+        PyDumper.add_representer(cls, cls.to_yaml)
+
+# passing the possible first characters lets the resolver skip regexes for most scalars
+for h in handlers:
+    oyaml.add_implicit_resolver('!sfpreset', sfpex, **h)
+    oyaml.add_implicit_resolver('!ccmsg', ccmsgex, list('0123456789'), **h)
+    oyaml.add_implicit_resolver('!rspec', rspecex, list('0123456789.ABCDEFGb#'), **h)
+    oyaml.add_implicit_resolver('!ftspec', ftspecex, list('0123456789.ABCDEFGb#'), **h)
 
 def resolve_as_flowmap(*path):
     pathkeys = list(zip(path[::2], path[1::2]))
-    oyaml.add_path_resolver('!flowmap', pathkeys, kind=dict, **handlers)
+    for h in handlers:
+        oyaml.add_path_resolver('!flowmap', pathkeys, kind=dict, **h)
     
 def resolve_as_flowseq(*path):
     pathkeys = list(zip(path[::2], path[1::2]))
-    oyaml.add_path_resolver('!flowseq', pathkeys, kind=list, **handlers)
+    for h in handlers:
+        oyaml.add_path_resolver('!flowseq', pathkeys, kind=list, **h)
 
 snode = oyaml.SequenceNode
 mnode = oyaml.MappingNode
@@ -233,6 +275,9 @@ resolve_as_flowseq(mnode, 'patches', mnode, None, mnode, 'cc')
 resolve_as_flowmap(mnode, 'router_rules', snode, None) 
 resolve_as_flowmap(mnode, 'patches', mnode, None, mnode, 'router_rules', snode, None) 
 
+resolve_as_flowmap(mnode, 'transforms', snode, None)
+resolve_as_flowmap(mnode, 'patches', mnode, None, mnode, 'transforms', snode, None)
+
 resolve_as_flowmap(mnode, 'cclinks', snode, None)
 resolve_as_flowmap(mnode, 'patches', mnode, None, mnode, 'cclinks', snode, None)
 
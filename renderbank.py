@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Description: renders a MIDI file through patches of a bank into WAV files, faster than realtime
+    uses an offline synth with no audio or MIDI drivers, so no sound card is needed
+    reports how many times faster than realtime each patch renders, a measure of its CPU cost
+"""
+import argparse, os, re, sys
+import patcher
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a MIDI file through the patches of a bank')
+    parser.add_argument('midifile', help='MIDI file to play')
+    parser.add_argument('-c', '--config', default='fluidpatcherconf.yaml', help='config file')
+    parser.add_argument('-b', '--bank', default='', help="bank file, default is the config's current bank")
+    parser.add_argument('-p', '--patch', action='append', default=[], help='patch name or number (from 1) to render, default is all')
+    parser.add_argument('-o', '--outdir', default='.', help='directory for the WAV files')
+    parser.add_argument('-t', '--tail', type=float, default=2.0, help='seconds to render after the last event')
+    args = parser.parse_args()
+
+    pxr = patcher.Patcher(args.config, offline=True)
+    try:
+        pxr.load_bank(args.bank or None)
+    except patcher.PatcherError as e:
+        sys.exit(str(e))
+    patches = []
+    for p in args.patch or range(pxr.patches_count()):
+        if isinstance(p, str) and p.isdigit():
+            p = int(p) - 1
+        patches.append(p)
+    os.makedirs(args.outdir, exist_ok=True)
+    total, totaltime = 0, 0
+    for p in patches:
+        try:
+            name = p if isinstance(p, str) else pxr.patch_name(p)
+            wavfile = os.path.join(args.outdir, re.sub('[^\w\-. ]', '_', name) + '.wav')
+            seconds, elapsed, warnings = pxr.render_patch(p, args.midifile, wavfile, args.tail)
+        except patcher.PatcherError as e:
+            print('%s: %s' % (p, e))
+            continue
+        for w in warnings:
+            print('  %s' % w)
+        total += seconds
+        totaltime += elapsed
+        print('%s: %.1fs of audio in %.2fs (%.1fx realtime)' % (name, seconds, elapsed, seconds / max(elapsed, 1e-9)))
+    if len(patches) > 1 and totaltime:
+        print('total: %.1fs of audio in %.2fs (%.1fx realtime)' % (total, totaltime, total / totaltime))
+
+if __name__ == '__main__':
+    main()
@@ -20,16 +20,8 @@ def scan_midiports():
             midiports[client] = port
     return midiports
 
-def list_banks():
-    bpaths = sorted(glob.glob(os.path.join(pxr.bankdir, '**', '*.yaml'), recursive=True), key=str.lower)
-    return [os.path.relpath(x, start=pxr.bankdir) for x in bpaths]
-
-def list_soundfonts():
-    sfpaths = sorted(glob.glob(os.path.join(pxr.sfdir, '**', '*.sf2'), recursive=True), key=str.lower)
-    return [os.path.relpath(x, start=pxr.sfdir) for x in sfpaths]
-
 def load_bank_menu():
-    banks = list_banks()
+    banks = pxr.list_banks()
     if not banks:
         sb.lcd_write("no banks found! ", 1)
         sb.waitforrelease(2)
@@ -80,6 +72,10 @@ if pxr.cfg.get('remotelink_active', 0):
     remote_link = netlink.Server(port, passkey)
 else:
     remote_link = None
+if pxr.cfg.get('metrics_port', 0):
+    metrics_server = netlink.MetricsServer(pxr.cfg['metrics_port'])
+else:
+    metrics_server = None
 
 # load bank
 sb.lcd_write("loading patches ", 1)
@@ -108,6 +104,7 @@ fxmenu_info = (
 )
 
 # update LCD
+sfprogress = (0, 0)
 while True:
     sb.lcd_clear()
     if pxr.sfpresets:
@@ -128,6 +125,14 @@ while True:
         sb.update()
         pxr.poll_cc()
 
+        # show progress of soundfonts loading in the background
+        if pxr.soundfont_progress() != sfprogress:
+            sfprogress = pxr.soundfont_progress()
+            if sfprogress[0] < sfprogress[1]:
+                sb.lcd_write("%16s" % ("loading %d/%d" % sfprogress), 1)
+            else:
+                break
+
         # patch/preset switching
         if SB.TAP in sb.buttons():
             if warn:
@@ -199,7 +204,7 @@ while True:
                 sb.waitforrelease(1)
                 
             elif k == 4: # load soundfont
-                sf = list_soundfonts()
+                sf = pxr.list_soundfonts()
                 if not sf:
                     sb.lcd_write("no soundfonts!  ", 1)
                     sb.waitforrelease(2)
@@ -237,7 +242,7 @@ while True:
         # left button menu - system-related tasks
         if sb.button('left') == SB.HOLD:
             sb.lcd_write("Options:        ", 0)
-            k = sb.choose_opt(['Power Down', 'MIDI Devices', 'Wifi Settings', 'Add From USB', 'Update Device'], row=1, passlong=True)
+            k = sb.choose_opt(['Power Down', 'MIDI Devices', 'Wifi Settings', 'Add From USB', 'Update Device', 'Patch Timing'], row=1, passlong=True)
             
             if k == 0: # power down
                 sb.lcd_write("Shutting down...", 0)
@@ -374,6 +379,17 @@ while True:
                     sb.lcd_write(str(e).replace('\n', ' '), 1)
                     while not sb.waitfortap(10): pass
 
+            elif k == 5: # show patch switch times
+                stats = pxr.timing_stats()
+                if not stats or 'select_patch' not in stats:
+                    sb.lcd_write("Patch Timing:   ", 0)
+                    sb.lcd_write("         no data", 1)
+                else:
+                    t = stats['select_patch']['total']
+                    sb.lcd_write(("p50 %.1fms" % t['p50']).ljust(16), 0)
+                    sb.lcd_write(("p99 %.1f/%.1f" % (t['p99'], t['max'])).rjust(16), 1)
+                sb.waitfortap(10)
+
             break
 
         # long-hold right button = reload bank
@@ -398,6 +414,10 @@ while True:
             sb.waitforrelease(1)
             sys.exit(1)
 
+        # answer metrics scrapes
+        if metrics_server:
+            metrics_server.serve(pxr.metrics)
+
         # check remote link for requests
         if remote_link and remote_link.pending():
             req = remote_link.requests.pop(0)
@@ -414,7 +434,7 @@ while True:
                     remote_link.reply(req, patcher.write_yaml(pxr.patch_names()))
                     
             elif req.type == netlink.LIST_BANKS:
-                banks = list_banks()
+                banks = pxr.list_banks()
                 if not banks:
                     remote_link.reply(req, "no banks found!", netlink.REQ_ERROR)
                 else:
@@ -461,7 +481,7 @@ while True:
                     break
                     
             elif req.type == netlink.LIST_SOUNDFONTS:
-                sf = list_soundfonts()
+                sf = pxr.list_soundfonts()
                 if not sf:
                     remote_link.reply(req, "no soundfonts!", netlink.REQ_ERROR)
                 else:
@@ -505,3 +525,12 @@ while True:
                     remote_link.reply(req, str(e), netlink.REQ_ERROR)
                 else:
                     remote_link.reply(req)
+
+            elif req.type == netlink.SOUNDFONT_PROGRESS:
+                remote_link.reply(req, patcher.write_yaml(list(pxr.soundfont_progress())))
+
+            elif req.type == netlink.TIMING_STATS:
+                remote_link.reply(req, patcher.write_yaml(pxr.timing_stats(req.body == 'reset') or {}))
+
+            elif req.type == netlink.METRICS:
+                remote_link.reply(req, patcher.write_yaml(pxr.metrics()))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Description: finds the lowest-latency audio buffer settings that stay glitch-free with a bank
+    renders a stress workload through the patches of a bank with an offline synth,
+    times each block of audio against the time it would take to play, simulates the
+    audio driver's buffers, and writes the best audio.period-size and audio.periods
+    into the config's fluidsettings
+"""
+import argparse, sys
+import patcher
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the audio buffer settings for a bank')
+    parser.add_argument('-c', '--config', default='fluidpatcherconf.yaml', help='config file')
+    parser.add_argument('-b', '--bank', default='', help="bank file, default is the config's current bank")
+    parser.add_argument('-p', '--patch', action='append', default=[], help='patch name or number (from 1) to test, default is all')
+    parser.add_argument('-n', '--polyphony', type=int, default=0, help='notes to hold, default is synth.polyphony')
+    parser.add_argument('-s', '--seconds', type=float, default=5.0, help='seconds of audio to render per patch and period size')
+    parser.add_argument('-m', '--margin', type=float, default=1.5, help='multiply render times by this, to leave time for the rest of the system')
+    parser.add_argument('--dry-run', action='store_true', help="don't write the result to the config file")
+    args = parser.parse_args()
+
+    pxr = patcher.Patcher(args.config, offline=True)
+    currentbank = pxr.cfg.get('currentbank')
+    try:
+        pxr.load_bank(args.bank or None)
+    except patcher.PatcherError as e:
+        sys.exit(str(e))
+    patches = [int(p) - 1 if p.isdigit() else p for p in args.patch] or None
+    try:
+        best, results = pxr.tune_audio(patches, args.polyphony, args.seconds, margin=args.margin)
+    except patcher.PatcherError as e:
+        sys.exit(str(e))
+    print('period-size periods latency  misses underruns')
+    for size, n, latency, misses, underruns in results:
+        print('%11d %7d %5.1fms %7d %9d' % (size, n, latency, misses, underruns))
+    if not best:
+        sys.exit('no setting was free of underruns')
+    print('best: audio.period-size %d, audio.periods %d' % best)
+    if not args.dry_run:
+        # load_bank made --bank the current bank, but only the audio settings should change
+        if currentbank == None:
+            pxr.cfg.pop('currentbank', None)
+        else:
+            pxr.cfg['currentbank'] = currentbank
+        pxr.write_config()
+        print('saved to %s' % args.config)
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,11 @@
 Description: tools for controlling patcher over a network
 """
 import socket, select
-from time import time_ns
+from time import time_ns, monotonic
 
 DEFAULT_PORT = 8675
 DEFAULT_PASSKEY = 'a9b8d3'
+DEFAULT_METRICS_PORT = 9675
 BUFSIZE = 1024
 
 # request types
@@ -22,6 +23,9 @@ LIST_PLUGINS = 20
 LIST_PORTS = 21
 READ_CFG = 22
 SAVE_CFG = 23
+SOUNDFONT_PROGRESS = 24
+TIMING_STATS = 25
+METRICS = 26
 # to be implemented(?):
 # SOFTWARE_UPDATE
 
@@ -42,6 +46,27 @@ def get_ip():
         s.close()
     return IP
 
+def exposition(metrics, prefix='fluidpatcher'):
+# format a dict from Patcher.metrics as plain text that metrics collectors can scrape
+    lines = []
+    def metric(name, type, samples):
+        lines.append('# TYPE %s_%s %s' % (prefix, name, type))
+        for suffix, labels, val in samples:
+            lines.append('%s_%s%s%s %s' % (prefix, name, suffix, labels, val))
+    for name in ['cpu_load', 'voices', 'polyphony', 'cclinks', 'router_rules']:
+        metric(name, 'gauge', [('', '', metrics[name])])
+    metric('overload_samples', 'counter', [('_total', '', metrics['overloads'])])
+    metric('soundfont_memory_bytes', 'gauge',
+           [('', '{soundfont="%s"}' % escape_label(sfont), val) for sfont, val in metrics['soundfont_memory'].items()])
+    for name in ['poll_cc', 'select_patch']:
+        hist = metrics[name]
+        samples = [('_bucket', '{le="%s"}' % ('+Inf' if le == float('inf') else le), n) for le, n in hist['buckets'].items()]
+        metric(name + '_milliseconds', 'histogram', samples + [('_sum', '', hist['sum']), ('_count', '', hist['count'])])
+    return '\n'.join(lines) + '\n'
+
+def escape_label(val):
+    return val.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
 
 class Message:
 
@@ -144,6 +169,81 @@ class Server:
             pass
 
 
+class MetricsServer:
+# answers HTTP requests on :port with the text exposition of a Patcher's metrics
+# polled from the main loop like Server, so metrics are read between other work
+# each call does one non-blocking pass over the sockets, so a slow or idle scraper
+# can't hold up the main loop; clients still connected after :timeout seconds are dropped
+
+    def __init__(self, port=DEFAULT_METRICS_PORT, addr='', timeout=5, maxclients=8):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(0)
+        self.socket.bind((addr, port))
+        self.socket.listen(5)
+        self.timeout = timeout
+        self.maxclients = maxclients
+        # socket: [deadline, reply bytes still to send or None while waiting for the request]
+        self.clients = {}
+
+    def __del__(self):
+        self.socket.close()
+        for sock in self.clients:
+            sock.close()
+
+    def serve(self, metrics):
+    # accept at most one new client, read waiting requests, and send what
+    # fits in the socket buffers, calling :metrics at most once for the dict to send
+        reading = [sock for sock, (deadline, out) in self.clients.items() if out == None]
+        writing = [sock for sock, (deadline, out) in self.clients.items() if out != None]
+        listen = [self.socket] if len(self.clients) < self.maxclients else []
+        readable, writable, errored = select.select(listen + reading, writing, [], 0)
+        reply = None
+        for sock in readable:
+            if sock == self.socket:
+                try:
+                    conn, address = self.socket.accept()
+                except OSError:
+                    continue
+                conn.setblocking(0)
+                self.clients[conn] = [monotonic() + self.timeout, None]
+                continue
+            try:
+                req = sock.recv(BUFSIZE)
+            except OSError:
+                req = b''
+            if not req.startswith(b'GET '):
+                self._drop(sock)
+                continue
+            if reply == None:
+                body = exposition(metrics()).encode()
+                hdr = 'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n' % len(body)
+                reply = hdr.encode() + body
+            self.clients[sock][1] = reply
+            writable.append(sock)
+        for sock in writable:
+            out = self.clients[sock][1]
+            try:
+                n = sock.send(out)
+            except BlockingIOError:
+                continue
+            except OSError:
+                self._drop(sock)
+                continue
+            if n < len(out):
+                self.clients[sock][1] = out[n:]
+            else:
+                self._drop(sock)
+        now = monotonic()
+        for sock, (deadline, out) in list(self.clients.items()):
+            if now > deadline:
+                self._drop(sock)
+
+    def _drop(self, sock):
+        sock.close()
+        del self.clients[sock]
+
+
 class Client:
 
     def __init__(self, server='', port=DEFAULT_PORT, passkey=DEFAULT_PASSKEY, timeout=20):